@@ -194,6 +194,64 @@ class TrainNNConfig(object):
     # value weight will automatically adjust based on whether overfitting occurs
     initial_value_weight = attribute(1.0)
 
+    # number of processes used to read/preprocess gendata files when syncing the data cache.  0
+    # will do it inline.
+    sync_workers = attribute(0)
+
+    # md5 hash every gendata file when syncing the data cache, rather than trusting cached
+    # fingerprints (size, mtime and inode) for files that look unchanged.
+    deep_verify_data_cache = attribute(False)
+
+    # store basestates in the data cache db as packed bits, rather than the channels.  Channels are
+    # created from the bits for each batch during training.
+    packed_states = attribute(False)
+
+    # store policies in the data cache db sparsely, as (legal, prob) pairs.  Dense policies are
+    # created for each batch during training.
+    sparse_policies = attribute(False)
+
+    # number of batches to prepare ahead of training in background threads (0 will prepare each
+    # batch inline, when keras asks for it).  prefetch_threads are used to prepare them.
+    prefetch_batches = attribute(0)
+    prefetch_threads = attribute(1)
+
+    # if > 0, batches are prepared by keras from a Sequence over the data cache, with this many
+    # worker processes (or threads if not sequence_multiprocessing).  Takes precedence over
+    # prefetch_batches.
+    sequence_workers = attribute(0)
+    sequence_multiprocessing = attribute(True)
+
+    # gather the validation samples into memory once, rather than reading them from the data cache
+    # every epoch.  with cache_validation_set, they are also saved in the data cache directory and
+    # reused while the db (and how they were chosen) is unchanged.
+    resident_validation = attribute(False)
+    cache_validation_set = attribute(False)
+
+    # if > 0, rather than a full shuffle of each epoch, shuffle the order of the db chunks and
+    # then shuffle within a window of this many chunks.  Means each chunk is decompressed about
+    # once per epoch.
+    shuffle_window_chunks = attribute(0)
+
+    # how the data cache db is stored: "bcolz" (compressed) or "npy" (memmapped .npy columns)
+    db_backend = attribute("bcolz")
+
+    # when doing data augmentation, apply a random symmetry to samples as each batch is created,
+    # rather than storing all the symmetries in the data cache.  requires packed_states.
+    lazy_augment_data = attribute(False)
+
+    # drop steps from the data cache that are older than resample_buckets will ever sample (see
+    # DataCache.compact()).  Keeps the size of the db bounded.
+    compact_data_cache = attribute(False)
+
+    # merge samples of a step with the same state (and previous states) into one, with averaged
+    # policies/value and a count (see DataCache.dedupe()).  Only new steps are merged after each
+    # sync.  requires packed_states.
+    dedupe_data_cache = attribute(False)
+
+    # store channels in the data cache as uint8 (or float16), and create batches of inputs as
+    # float16 rather than float32.  Cuts the memory/disk bandwidth of inputs by 2-4x.
+    compact_inputs = attribute(False)
+
 
 @register_attrs
 class WorkerConfig(object):
@@ -259,3 +317,6 @@ class ServerConfig(object):
 
     # save the samples every n seconds
     checkpoint_interval = attribute(60.0 * 5)
+
+    # format of the saved samples: "json" (gzipped) or "binary" (columnar, see util/gendata.py)
+    gendata_format = attribute("json")
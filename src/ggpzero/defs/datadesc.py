@@ -127,6 +127,63 @@ class StepSummary(object):
     # [(0.1, 200), (0.1, 200),... (0.9, 200)]
     stats_av_puct_score_dist = attr.ib(attr.Factory(list))
 
+    # number of samples in the gendata file itself (num_samples may differ, after augmenting or
+    # merging).  None for summaries from before it was recorded.
+    file_num_samples = attr.ib(None)
+
+
+@register_attrs
+class StageMetrics(object):
+    name = attr.ib("decode")
+    seconds = attr.ib(0.0)
+    samples = attr.ib(0)
+
+    # bytes read/written by this stage (eg gendata file read, columns written to db)
+    bytes_read = attr.ib(0)
+    bytes_written = attr.ib(0)
+
+
+@register_attrs
+class IngestMetrics(object):
+    ' metrics of ingesting one gendata file into the data cache '
+    step = attr.ib(42)
+    filename = attr.ib("gendata_hexLG11_6.json.gz")
+    date_created = attr.ib('2018-01-24 22:28')
+
+    num_samples = attr.ib(50000)
+
+    # from starting to read the file, until the last of its samples are in the db
+    wall_seconds = attr.ib(0.0)
+
+    # how the data cache was configured (so ingests can be compared like for like)
+    config = attr.ib(attr.Factory(dict))
+
+    # isinstance StageMetrics
+    stages = attr.ib(attr.Factory(list))
+
+
+@register_attrs
+class IngestMetricsHistory(object):
+    # isinstance IngestMetrics, in order of ingest (across all syncs, including rebuilds)
+    ingests = attr.ib(attr.Factory(list))
+
+
+@register_attrs
+class FileFingerprint(object):
+    # if the path, size, mtime and inode of a file are unchanged, assume the md5sum is too
+    path = attr.ib("/path/to/gendata_hexLG11_6.json.gz")
+    size = attr.ib(42)
+    mtime = attr.ib(1516832880.0)
+    inode = attr.ib(42)
+
+    md5sum = attr.ib("93d6ce4b812d353c73f4a8ca5b605d37")
+
+
+@register_attrs
+class FileFingerprints(object):
+    # isinstance FileFingerprint
+    fingerprints = attr.ib(attr.Factory(list))
+
 
 @register_attrs
 class GenDataSummary(object):
@@ -135,5 +192,32 @@ class GenDataSummary(object):
     last_updated = attr.ib('2018-01-24 22:28')
     total_samples = attr.ib(10**10)
 
+    # steps before this have been compacted out of the db (see DataCache.compact())
+    first_step = attr.ib(0)
+
+    # steps up to and including this have had duplicate states merged (see DataCache.dedupe())
+    deduped_step = attr.ib(-1)
+
     # isinstance StepSummary
     step_summaries = attr.ib(attr.Factory(list))
+
+
+@register_attrs
+class TransformerSpaces(object):
+    ''' the spaces computed by GdlBasesTransformer.init_spaces(), so they can be cached on disk
+        rather than re-symbolizing all the bases of the game on every start '''
+    game = attr.ib("breakthrough")
+
+    # md5sum of the game's gdl, game model, game description and generation description (see bases.spaces_key())
+    key = attr.ib("93d6ce4b812d353c73f4a8ca5b605d37")
+
+    # [base_indx, channel_id, x_idx, y_idx] for each BaseToBoardSpace
+    board_space = attr.ib(attr.Factory(list))
+
+    # [base_indx, channel_id, value] for each BaseToChannelSpace
+    control_space = attr.ib(attr.Factory(list))
+
+    raw_channels_per_state = attr.ib(2)
+    num_of_controls_channels = attr.ib(1)
+    num_unhandled_states = attr.ib(0)
+    policy_dist_count = attr.ib(attr.Factory(list))
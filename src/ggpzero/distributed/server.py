@@ -24,7 +24,7 @@ from twisted.internet import reactor
 from ggplib.util import log
 from ggplib.db import lookup
 
-from ggpzero.util import attrutil
+from ggpzero.util import attrutil, gendata
 from ggpzero.util.broker import Broker, ServerFactory
 
 from ggpzero.defs import msgs, confs, datadesc, templates
@@ -70,6 +70,7 @@ class ServerBroker(Broker):
             conf = attrutil.json_to_attr(open(conf_filename).read())
 
         assert isinstance(conf, confs.ServerConfig)
+        assert conf.gendata_format in ("json", "binary")
         attrutil.pprint(conf)
 
         self.conf = conf
@@ -294,12 +295,14 @@ class ServerBroker(Broker):
     def sample_data_filename(self):
         man = get_manager()
         p = man.samples_path(self.conf.game, self.conf.generation_prefix)
-        return os.path.join(p, "gendata_%s_%s.json.gz" % (self.conf.game,
-                                                          self.conf.current_step))
+        ext = gendata.BINARY_EXT if self.conf.gendata_format == "binary" else gendata.JSON_EXT
+        return os.path.join(p, "gendata_%s_%s%s" % (self.conf.game,
+                                                    self.conf.current_step,
+                                                    ext))
 
     def save_sample_data(self):
         if self.training_in_progress:
-            log.warning("skip writing json (gzipped): %s" % self.sample_data_filename)
+            log.warning("skip writing samples: %s" % self.sample_data_filename)
             return
 
         gen_samples = datadesc.GenerationSamples()
@@ -312,6 +315,11 @@ class ServerBroker(Broker):
         gen_samples.num_samples = min(len(self.accumulated_samples), self.conf.num_samples_to_train)
         gen_samples.samples = self.accumulated_samples[:gen_samples.num_samples]
 
+        if self.conf.gendata_format == "binary":
+            log.info("writing binary: %s" % self.sample_data_filename)
+            gendata.write_binary(self.sample_data_filename, gen_samples, gen_samples.samples)
+            return gen_samples
+
         # write json file
         json.encoder.FLOAT_REPR = lambda f: ("%.5f" % f)
 
@@ -324,11 +332,12 @@ class ServerBroker(Broker):
     def load_and_check_data(self):
         log.info("checking if generation data available")
         try:
-            gen_samples = attrutil.json_to_attr(gzip.open(self.sample_data_filename).read())
-            log.info("data exists, with generation: %s, adding %s samples" % (gen_samples.with_generation,
-                                                                              gen_samples.num_samples))
+            # streams the samples in, rather than decoding the entire file at once
+            reader = gendata.get_reader(self.sample_data_filename)
+            self.add_new_samples(reader, dedupe=False)
 
-            self.add_new_samples(gen_samples.samples, dedupe=False)
+            log.info("data exists, with generation: %s, added %s samples" % (reader.header.with_generation,
+                                                                             reader.header.num_samples))
 
         except IOError as exc:
             log.info("Not such file for generation: %s" % exc)
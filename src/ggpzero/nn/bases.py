@@ -1,3 +1,6 @@
+import json
+import hashlib
+
 import numpy as np
 
 from ggplib.util import log
@@ -5,6 +8,7 @@ from ggplib.util import log
 # only importing for checking type (otherwise will go insane)
 from ggplib.db.lookup import GameInfo
 
+from ggpzero.util import attrutil
 from ggpzero.util.state import decode_state
 from ggpzero.defs import datadesc, gamedesc
 
@@ -29,6 +33,27 @@ def create_base_infos(game_model):
     return [BaseInfo(idx, symbol_factory.symbolize(s)) for idx, s in enumerate(game_model.bases)]
 
 
+# bump whenever the computation of the spaces changes, to invalidate cached TransformerSpaces
+SPACES_VERSION = 2
+
+
+def spaces_key(game_info, game_desc, generation_descr):
+    ' md5sum identifying the spaces of a transformer (see datadesc.TransformerSpaces) '
+    sm_model = game_info.model
+    desc = generation_descr
+
+    m = hashlib.md5()
+    m.update(json.dumps([SPACES_VERSION, game_info.game]))
+
+    # the gdl itself, so a changed game description (with the same bases/actions) can't reuse stale spaces
+    m.update(game_info.gdl_str)
+    m.update(json.dumps([sm_model.roles, sm_model.bases, sm_model.actions]))
+    m.update(attrutil.attr_to_json(game_desc))
+    m.update(json.dumps([desc.channel_last, desc.multiple_policy_heads,
+                         desc.num_previous_states, desc.draw_head]))
+    return m.hexdigest()
+
+
 class BaseToBoardSpace(object):
     def __init__(self, base_indx, channel_id, x_cord_idx, y_cord_idx):
         # which base it is
@@ -62,7 +87,7 @@ class BaseToChannelSpace(object):
 
 
 class GdlBasesTransformer(object):
-    def __init__(self, game_info, generation_descr, game_desc=None, verbose=False):
+    def __init__(self, game_info, generation_descr, game_desc=None, verbose=False, spaces=None):
         assert isinstance(game_info, GameInfo)
         assert isinstance(generation_descr, datadesc.GenerationDescription)
         self.game_info = game_info
@@ -89,7 +114,7 @@ class GdlBasesTransformer(object):
         self.num_rewards = 3 if generation_descr.draw_head else 2
 
         assert self.num_previous_states >= 0
-        self.init_spaces()
+        self.init_spaces(spaces)
 
         #log.debug("num_channels: {}".format(self.num_channels))
         #log.debug("raw_channels_per_state: {}".format(self.raw_channels_per_state))
@@ -124,27 +149,43 @@ class GdlBasesTransformer(object):
     def num_bases(self):
         return len(self.game_info.model.bases)
 
+    @property
+    def num_packed_bytes(self):
+        ' size of a basestate when packed as bits '
+        return (self.num_bases + 7) // 8
+
     @property
     def num_channels(self):
         # one for each role to indicate turn, one for each pieces
         total_states = self.num_previous_states + 1
         return self.num_of_controls_channels + self.raw_channels_per_state * total_states
 
-    def init_spaces(self):
-        base_infos = create_base_infos(self.game_info.model)
+    def init_spaces(self, spaces=None):
+        ' spaces (datadesc.TransformerSpaces) are from a previous get_spaces(), skipping symbolizing '
+        base_infos = None
+        if spaces is None:
+            base_infos = create_base_infos(self.game_info.model)
 
-        self.board_space = self.create_board_space(base_infos)
-        self.raw_channels_per_state = max(b.channel_id for b in self.board_space) + 1
+            self.board_space = self.create_board_space(base_infos)
+            self.raw_channels_per_state = max(b.channel_id for b in self.board_space) + 1
 
-        self.control_space = self.create_control_space(base_infos)
+            self.control_space = self.create_control_space(base_infos)
 
-        self.num_of_controls_channels = len(self.game_desc.control_channels)
+            self.num_of_controls_channels = len(self.game_desc.control_channels)
 
-        # warn about any unhandled states
-        self.num_unhandled_states = 0
-        for b_info in base_infos:
-            if not b_info.used:
-                self.num_unhandled_states += 1
+            # warn about any unhandled states
+            self.num_unhandled_states = 0
+            for b_info in base_infos:
+                if not b_info.used:
+                    self.num_unhandled_states += 1
+
+        else:
+            assert spaces.policy_dist_count == self.policy_dist_count
+            self.board_space = [BaseToBoardSpace(*b) for b in spaces.board_space]
+            self.raw_channels_per_state = spaces.raw_channels_per_state
+            self.control_space = [BaseToChannelSpace(*c) for c in spaces.control_space]
+            self.num_of_controls_channels = spaces.num_of_controls_channels
+            self.num_unhandled_states = spaces.num_unhandled_states
 
         if self.num_unhandled_states:
             log.warning("Number of unhandled states %d" % self.num_unhandled_states)
@@ -158,6 +199,9 @@ class GdlBasesTransformer(object):
             self.by_channel.setdefault(cs.channel_id + self.raw_channels_per_state, []).append(cs)
 
         if self.verbose:
+            if base_infos is None:
+                base_infos = create_base_infos(self.game_info.model)
+
             for channel_id, all in self.by_channel.items():
                 print()
                 print("channel_id: %s" % channel_id)
@@ -165,6 +209,30 @@ class GdlBasesTransformer(object):
                 for x in all:
                     print("%s -> %s" % (base_infos[x.base_indx].terms, x))
 
+        self.init_scatter_maps()
+
+    def get_spaces(self):
+        ' the computed spaces, to be passed to a later transformer of the same game and description '
+        return datadesc.TransformerSpaces(game=self.game,
+                                          board_space=[[b.base_indx, b.channel_id, b.x_idx, b.y_idx]
+                                                       for b in self.board_space],
+                                          control_space=[[c.base_indx, c.channel_id, c.value]
+                                                         for c in self.control_space],
+                                          raw_channels_per_state=self.raw_channels_per_state,
+                                          num_of_controls_channels=self.num_of_controls_channels,
+                                          num_unhandled_states=self.num_unhandled_states,
+                                          policy_dist_count=list(self.policy_dist_count))
+
+    def init_scatter_maps(self):
+        ' flat index arrays of board_space/control_space, for transforming batches of states '
+
+        # board_space base indices, and their index into the flattened channels of a state
+        self.board_space_bases = np.array([b.base_indx for b in self.board_space], dtype=np.int64)
+        self.board_space_flat_idx = np.array([(b.channel_id * self.num_cols + b.y_idx) * self.num_rows + b.x_idx
+                                              for b in self.board_space], dtype=np.int64)
+
+        self.control_space_bases = np.array([c.base_indx for c in self.control_space], dtype=np.int64)
+
     def create_board_space(self, base_infos):
         board_space = []
 
@@ -245,8 +313,7 @@ class GdlBasesTransformer(object):
             prev_states = []
 
         # create a bunch of zero channels
-        channels = [np.zeros((self.num_cols, self.num_rows))
-                    for _ in range(self.num_channels)]
+        channels = np.zeros((self.num_channels, self.num_cols, self.num_rows), dtype='float32')
 
         # add the state to channels
         for b in self.board_space:
@@ -277,15 +344,91 @@ class GdlBasesTransformer(object):
                 # the value to set the entire channel (flood fill)
                 channels[channel_idx] += c.value
 
-        channels = np.array(channels, dtype='float32')
+        # channels are created channel first, a single copy to channel last
+        if self.channel_last:
+            channels = np.ascontiguousarray(channels.transpose(1, 2, 0))
+
+        return channels
+
+    @property
+    def compact_input_dtype(self):
+        ''' smallest dtype for storing channels.  board channels are 0/1, so uint8 unless a
+        control channel can be fractional (see gamedesc.step_control()) or outside 0-255, then
+        float16 (or float32 if it won't fit). '''
+        # the values of all the set control bases of a channel are summed, so check the extremes
+        lowest = np.zeros(self.num_of_controls_channels)
+        highest = np.zeros(self.num_of_controls_channels)
+        for c in self.control_space:
+            if c.value != int(c.value):
+                return np.dtype('float16')
+
+            lowest[c.channel_id] += min(0, c.value)
+            highest[c.channel_id] += max(0, c.value)
+
+        if lowest.min() < -np.finfo(np.float16).max or highest.max() > np.finfo(np.float16).max:
+            return np.dtype('float32')
+
+        if lowest.min() < 0 or highest.max() > 255:
+            return np.dtype('float16')
+
+        return np.dtype('uint8')
+
+    def states_to_channels(self, states, prev_states=None, dtype='float32'):
+        ''' batch version of state_to_channels() - exactly the same as calling it for each state.
+
+        states: uint8 bit matrix of shape (N, num_bases) (as decode_states(), rows may be padded)
+        prev_states: uint8 bit array of shape (N, num_previous_states, num_bases).  A previous
+        state with no bits set is the same as it not existing.
+        dtype: of the returned channels (see compact_input_dtype) '''
+
+        num_samples = len(states)
+        channel_size = self.channel_size
+        channels = np.zeros((num_samples, self.num_channels * channel_size), dtype=dtype)
+
+        def add_board_space(bits, channel_incr):
+            rows, indices = np.nonzero(bits[:, self.board_space_bases])
+            channels[rows, self.board_space_flat_idx[indices] + channel_incr * channel_size] = 1
+
+        # add the state to channels
+        add_board_space(states, 0)
+
+        # add any previous states to the channels
+        channel_incr = self.raw_channels_per_state
+        for ii in range(self.num_previous_states):
+            if prev_states is not None:
+                add_board_space(prev_states[:, ii], channel_incr)
+
+            channel_incr += self.raw_channels_per_state
+
+        channels = channels.reshape(num_samples, self.num_channels, self.num_cols, self.num_rows)
+
+        # set a control state by setting entire channel to value (flood fill)
+        if self.control_space:
+            bits = states[:, self.control_space_bases]
+            values = np.zeros((num_samples, self.num_of_controls_channels))
+            for ii, c in enumerate(self.control_space):
+                values[:, c.channel_id] += bits[:, ii] * c.value
+
+            channels[:, channel_incr:] += values.astype(dtype)[:, :, np.newaxis, np.newaxis]
+
+        # the whole batch is converted to channel last in one go
         if self.channel_last:
-            orig = channels
-            channels = np.rollaxis(channels, -1)
-            channels = np.rollaxis(channels, -1)
-            assert channels.shape == (orig.shape[1], orig.shape[2], orig.shape[0])
+            channels = np.ascontiguousarray(channels.transpose(0, 2, 3, 1))
 
         return channels
 
+    def packed_states_to_channels(self, packed_states, packed_prev_states=None, dtype='float32'):
+        ''' states_to_channels(), where states are packed bits (as stored in the db).
+
+        packed_states: uint8 array of shape (N, num_packed_bytes)
+        packed_prev_states: uint8 array of shape (N, num_previous_states, num_packed_bytes) '''
+        prev_states = None
+        if packed_prev_states is not None:
+            prev_states = np.unpackbits(packed_prev_states, axis=-1)
+
+        return self.states_to_channels(np.unpackbits(packed_states, axis=-1), prev_states,
+                                       dtype=dtype)
+
     def check_sample(self, sample):
         # XXX this should be ==.  But since our encode/decode can end up padding
         assert len(decode_state(sample.state)) >= self.num_bases
@@ -309,10 +452,26 @@ class GdlBasesTransformer(object):
 
         return array
 
+    def policies_to_array(self, legals, probs, counts, role_index):
+        ''' batch version of policy_to_array().  The policies are in CSR form: legals/probs are the
+        (legal, prob) pairs of all the policies concatenated, and counts the number of pairs in
+        each policy.  returns a dense array, one row per policy. '''
+        counts = np.asarray(counts)
+        rows = np.repeat(np.arange(len(counts)), counts)
+        array = np.zeros((len(counts), self.policy_dist_count[role_index]), dtype='float32')
+        array[rows, legals] = probs
+        return array
+
     def value_to_array(self, values):
         assert len(values) == self.role_count
         return np.array(values, dtype='float32')
 
+    def values_to_array(self, values):
+        ' batch version of value_to_array(), values is (N x role_count) '
+        values = np.array(values, dtype='float32')
+        assert values.ndim == 2 and values.shape[1] == self.role_count
+        return values
+
     def get_symmetries_desc(self):
         gds = gamedesc.GameSymmetries()
         if hasattr(gds, self.game):
@@ -332,3 +491,16 @@ class GdlBasesTransformer_Draws(GdlBasesTransformer):
             new_values = [values[0], values[1], 0.0]
 
         return np.array(new_values, dtype='float32')
+
+    def values_to_array(self, values):
+        values = np.array(values, dtype=np.float64)
+        assert values.ndim == 2 and values.shape[1] == 2
+        assert (np.abs(values.sum(axis=1) - 1.0) < 0.01).all()
+
+        draws = np.abs(values[:, 0] - 0.5) < 0.01
+        assert (np.abs(values[draws, 1] - 0.5) < 0.01).all()
+
+        new_values = np.zeros((len(values), 3), dtype='float32')
+        new_values[:, :2] = values
+        new_values[draws] = [0.0, 0.0, 1.0]
+        return new_values
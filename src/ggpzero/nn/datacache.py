@@ -9,11 +9,21 @@ todo
 Train Pipeline Overview:
 ========================
 
-db is a bcolz table (and bcolz is awesome!)
+db is a bcolz table (and bcolz is awesome!), or with db_backend="npy" a directory of memmapped .npy
+columns (see storage.py)
+ * columns are either channels (the inputs to network), or with packed_states the basestate (and
+   previous basestates) packed as bits, which are expanded to channels for each batch in generate().
+ * with compact_inputs, channels are stored as uint8 (float16 if a control channel is fractional)
+   and batches of inputs are float16, only becoming float32 when fed to the network.
 gendata_ZZZ_YY.json.gz - are json data files produced from self play (one server, n workers).
+Or gendata_ZZZ_YY.npz for the binary format (see util/gendata.py), which is used in preference.
  * ZZZ is game
  * YY is network generation step played with
 gendata_summary.json - summary of the json data files, and what is in db
+gendata_fingerprints.json - md5sums of the json data files, only recomputed if a file's path, size,
+mtime or inode changes (or deep_verify)
+gendata_metrics.jsonl - per stage timings/samples/bytes of each ingested file (see util/metrics.py),
+one json line per file.  View with "datacache_tool.py metrics"
 
 
 init
@@ -23,11 +33,28 @@ init
 * if invalid - delete db or summary file (if the exist).  Create new db & summary.
 
 
+compact
+-------
+* optionally, drop the oldest steps outside of the buckets window from the db (the gendata files
+  are left as is).  The summary's first_step is the first step still in the db.
+
+
+dedupe
+------
+* optionally (dedupe_states), merge rows of a step with the same packed state and previous states
+  into the most recent of them.  The policies and value are averaged, weighted by the count column
+  (the number of samples merged into a row).  The step summaries' num_samples are the rows left in
+  the db for each step.  Only steps after the summary's deduped_step are merged, so only the end of
+  the db is rewritten.
+
+
 sync
 ----
 * check directory for any recent gendata files:
   * read new data, and preprocess into numpy arrays (for training data to keras/tf)
-  * add the numpy data to db
+  * add the numpy data to db (in chunks of ingest_chunk_size, with one append per chunk)
+  * optionally, files are read/preprocessed in worker processes (sync_workers).  The parent still
+    appends to the db in file order, so the db is the same as syncing inline.
   * update the summary file
 
 
@@ -35,8 +62,18 @@ create an indexer
 -----------------
 * specified from buckets
 * create a ChunkIndexer - which will create train/validation batches for one epoch
+* optionally block shuffled (window_chunks), so batches are read from a few db chunks at a time
 * XXX what about weightings from training data?  Future step.
 
+generate
+--------
+* batches are built from the db rows of the indices, either inline (generate()) or ahead of time
+  in background threads (prefetch_generate(), see BatchPrefetcher)
+* with lazy_augment, the db only has the samples as played, and a random symmetry is applied to
+  each sample of a training batch
+* resident_set() gathers samples (ie the validation set) into memory once, optionally saved as
+  __resident_<hash>__.npz, keyed on the summary
+
 callbacks
 ---------
 * before each epoch.  Idea is to keep epochs small (1 million) (XXX todo)
@@ -46,28 +83,31 @@ callbacks
 # std imports
 import gc
 import os
-import sys
-import gzip
+import copy
 import math
 import time
 import random
+import shutil
 import hashlib
 import datetime
+import threading
+import traceback
+import multiprocessing
 
 # 3rd party imports
-import bcolz
 import numpy as np
 
 # ggplib imports
 from ggplib.util import log
 
 # ggpzero imports
-from ggpzero.util import attrutil, symmetry
+from ggpzero.util import attrutil, func, gendata, metrics, symmetry
 
 from ggpzero.defs import datadesc
+from ggpzero.nn import storage
 from ggpzero.nn.manager import get_manager
 
-from ggpzero.util.state import fast_decode_state
+from ggpzero.util.state import decode_states, pack_state
 
 
 DEBUG = False
@@ -84,6 +124,18 @@ class ElaspedTime(object):
         return elapsed
 
 
+def md5sum_file(file_path, read_size=1024 * 1024):
+    m = hashlib.md5()
+    with open(file_path, "rb") as f:
+        while True:
+            buf = f.read(read_size)
+            if not buf:
+                break
+            m.update(buf)
+
+    return m.hexdigest()
+
+
 class Check(Exception):
     pass
 
@@ -98,15 +150,25 @@ def reshape(d):
     return np.concatenate([d], axis=0).reshape(new_shape)
 
 
-def fake_columns(transformer):
+def fake_columns(transformer, packed_states=False, sparse_policies=False, channels_dtype='float32'):
     # fake some data. Note that we could use the gendata_X instead of doing this, but this at least
     # gives us a warm fuzzy that something isn't badly configured.
     t = transformer
     sm = t.game_info.get_sm()
     basestate = sm.get_initial_state()
-    channels = t.state_to_channels(basestate.to_list())
 
-    cols = [reshape(channels)]
+    if packed_states:
+        packed = pack_state(basestate.to_list())
+        assert len(packed) == t.num_packed_bytes
+        cols = [reshape(packed)]
+
+        if t.num_previous_states:
+            prev_states = np.zeros((t.num_previous_states, t.num_packed_bytes), dtype=np.uint8)
+            cols.append(reshape(prev_states))
+
+    else:
+        channels = t.state_to_channels(basestate.to_list()).astype(channels_dtype)
+        cols = [reshape(channels)]
 
     # create a fake policy for each role
     for role_index in range(len(sm.get_roles())):
@@ -115,16 +177,26 @@ def fake_columns(transformer):
         # create a uniform policy
         policy = [(ls.get_legal(c), 1 / float(ls.get_count())) for c in range(ls.get_count())]
 
-        policy_array = t.policy_to_array(policy, role_index)
-        cols.append(reshape(policy_array))
+        if sparse_policies:
+            # start/count into the policy table
+            cols.append(np.array([0], dtype=np.int64))
+            cols.append(np.array([len(policy)], dtype=np.int32))
+
+        else:
+            policy_array = t.policy_to_array(policy, role_index)
+            cols.append(reshape(policy_array))
 
     value_head = transformer.value_to_array([0, 1])
     cols.append(reshape(value_head))
 
-    assert len(cols) == 4
     return cols
 
 
+def fake_policy_columns():
+    ' columns of a policy table (for sparse policies), (legal, prob) pairs '
+    return [np.array([0], dtype=np.int32), np.array([1.0], dtype=np.float32)]
+
+
 class Buckets(object):
     def __init__(self, bucket_def):
         self.bucket_def = bucket_def
@@ -147,12 +219,44 @@ class Buckets(object):
 
         return -1
 
+    def window(self):
+        ' number of most recent levels that can be sampled from, or None if there is no limit '
+        if not self.bucket_def:
+            return None
+
+        cut_off, _ = self.bucket_def[-1]
+        if cut_off < 0:
+            return None
+
+        return cut_off
+
+
+def block_shuffle(indices, chunk_len, window_chunks):
+    ''' shuffles indices (a numpy array), keeping indices in the same db chunk (of chunk_len rows)
+    close together.  The order of the chunks is shuffled, and then indices are shuffled within a
+    window of window_chunks chunks.  Hence consecutive batches read from a few chunks at a time. '''
+    assert chunk_len > 0 and window_chunks > 0
+    indices = np.asarray(indices)
+
+    # give each chunk a random position, and hence a window
+    chunk_ids, chunk_of_index = np.unique(indices // chunk_len, return_inverse=True)
+    chunk_position = np.random.permutation(len(chunk_ids))
+    window_of_index = chunk_position[chunk_of_index] // window_chunks
+
+    # sort by window, and randomly within a window
+    order = np.lexsort((np.random.random(len(indices)), window_of_index))
+    return indices[order]
+
 
 class ChunkIndexer(object):
-    def __init__(self, buckets, step_summaries):
+    def __init__(self, buckets, step_summaries, chunk_len=None, window_chunks=0):
         self.buckets = buckets
         self.step_summaries = step_summaries
 
+        # if window_chunks, shuffle with block_shuffle() rather than a full shuffle
+        self.chunk_len = chunk_len
+        self.window_chunks = window_chunks
+
     def find_levels(self, starting_step=None,
                     ignore_after_step=None,
                     validation_split=0.9):
@@ -172,8 +276,9 @@ class ChunkIndexer(object):
         # note: step_summaries : step is increasing from 0
 
         index = 0
-        for step, summary in enumerate(self.step_summaries):
-            assert step == summary.step
+        for summary in self.step_summaries:
+            # note: the first step may not be 0, if the db has been compacted
+            step = summary.step
 
             # ignore the most recent levels?
             if starting_step is not None and step > starting_step:
@@ -201,21 +306,23 @@ class ChunkIndexer(object):
         assert len(self.train_levels) == len(self.validation_levels)
 
     def create_indices_for_level(self, level_index, validation=False, max_size=-1):
-        ''' returns a shuffled list of indices '''
+        ''' returns a shuffled numpy array of indices '''
         step, start, end = self.validation_levels[level_index] if validation else self.train_levels[level_index]
         step2, num_games = self.num_games_levels[level_index]
         assert step == step2
 
-        self.debug_create_indices.append((level_index, step, start, end, max_size, num_games))
+        # a step can have no rows (eg an empty gendata file)
+        if end == start:
+            return np.zeros(0, dtype=np.int64)
 
-        indices = range(start, end)
+        self.debug_create_indices.append((level_index, step, start, end, max_size, num_games))
 
-        random.shuffle(indices)
+        indices = np.random.permutation(end - start)
 
         if max_size > 0:
             indices = indices[:max_size]
 
-        return indices
+        return indices + start
 
     def get_indices(self, max_size=None, validation=False, include_all=None):
         '''
@@ -304,9 +411,10 @@ class ChunkIndexer(object):
 
         self.debug_create_indices = []
 
-        all_indices = []
+        all_indices = [np.zeros(0, dtype=np.int64)]
         for ii, s in enumerate(sizes):
-            all_indices += self.create_indices_for_level(ii, validation=validation, max_size=s)
+            all_indices.append(self.create_indices_for_level(ii, validation=validation, max_size=s))
+        all_indices = np.concatenate(all_indices)
 
         log.debug("debug_create_indices (depth, step, start, finish, sz, #games)")
         if len(self.debug_create_indices) > 5:
@@ -320,6 +428,8 @@ class ChunkIndexer(object):
 
         total_unique_games = sum([dci[5] for dci in self.debug_create_indices])
         def f(x):
+            if x[3] == x[2]:
+                return 0
             return (x[4] / float(x[3] - x[2])) * x[5]
         pct_total_unique_games = int(sum([f(dci) for dci in self.debug_create_indices]))
 
@@ -329,7 +439,10 @@ class ChunkIndexer(object):
                                                                            total_unique_games,
                                                                            pct_total_unique_games))
 
-        random.shuffle(all_indices)
+        if self.window_chunks > 0:
+            return block_shuffle(all_indices, self.chunk_len, self.window_chunks)
+
+        np.random.shuffle(all_indices)
         return all_indices
 
     def training_epoch(self, epoch_size=None, include_all=None):
@@ -351,7 +464,7 @@ class StatsAccumulator(object):
         # when all policies lengths = 1
         self.bare_policies = 0
 
-        # match_identifier -> [depths]
+        # match_identifier -> [first depth, last depth]
         self.match_depths = {}
 
         self.total_resigns = 0
@@ -367,82 +480,167 @@ class StatsAccumulator(object):
         d = [0.01, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99, 1.0]
         self.total_puct_score_dist = [[x, 0] for x in d]
 
+    # the averages are 0 when there are no samples (eg an empty gendata file)
     @property
     def unique_matches(self):
         return len(self.match_depths)
 
     @property
     def draw_ratio(self):
-        return self.total_draws / float(self.num_samples)
+        return self.total_draws / float(max(1, self.num_samples))
 
     @property
     def bare_policies_ratio(self):
-        return self.bare_policies / float(self.num_samples)
+        return self.bare_policies / float(max(1, self.num_samples))
 
     @property
     def av_starting_depth(self):
-        return sum(m[0] for m in self.match_depths.values()) / float(self.unique_matches)
+        return sum(m[0] for m in self.match_depths.values()) / float(max(1, self.unique_matches))
 
     @property
     def av_ending_depth(self):
-        return sum(m[-1] for m in self.match_depths.values()) / float(self.unique_matches)
+        return sum(m[-1] for m in self.match_depths.values()) / float(max(1, self.unique_matches))
 
     @property
     def av_resigns(self):
-        return self.total_resigns / float(self.num_samples)
+        return self.total_resigns / float(max(1, self.num_samples))
 
     @property
     def av_resign_false_positive(self):
-        return self.total_false_positives / float(self.num_samples)
+        return self.total_false_positives / float(max(1, self.num_samples))
 
     @property
     def av_puct_visits(self):
-        return self.total_puct_visits / float(self.num_samples)
+        return self.total_puct_visits / float(max(1, self.num_samples))
 
     @property
     def av_final_scores(self):
-        return [(s / float(self.num_samples)) for s in self.total_final_scores_per_roles]
+        return [(s / float(max(1, self.num_samples))) for s in self.total_final_scores_per_roles]
 
     @property
     def ratio_of_roles(self):
-        return [(x / float(self.num_samples)) for x in self.total_ratio_of_roles]
+        return [(x / float(max(1, self.num_samples))) for x in self.total_ratio_of_roles]
 
     @property
     def av_puct_score_dist(self):
-        return str([(p, total / float(self.num_samples)) for p, total in self.total_puct_score_dist])
+        return str([(p, total / float(max(1, self.num_samples))) for p, total in self.total_puct_score_dist])
 
     def add(self, sample, was_draw=False):
-        self.num_samples += 1
-        self.total_draws += 1 if was_draw else 0
-        self.bare_policies += 1 if all(len(p) == 1 for p in sample.policies) else 0
-        self.match_depths.setdefault(sample.match_identifier, []).append(sample.depth)
-
-        self.total_resigns += 1 if sample.has_resigned else 0
-        self.total_false_positives += 1 if sample.resign_false_positive else 0
-        self.total_puct_visits += sample.resultant_puct_visits
-
-        for ri in range(2):
-            if len(sample.policies[ri]) > 1:
-                self.total_ratio_of_roles[ri] += 1
-
-        for ii, score in enumerate(sample.final_score):
-            self.total_final_scores_per_roles[ii] += score
-
-        indx = 0
-        score = sample.resultant_puct_score[0]
-        for ii, (upper_limit, _) in enumerate(self.total_puct_score_dist):
-            if (score - 0.0001) < upper_limit:
-                continue
+        self.add_batch([sample], [was_draw])
+
+    def add_batch(self, samples, was_draws):
+        ' adds a chunk of samples at once.  was_draws is whether each sample was a draw. '
+        cols = dict(has_resigned=[s.has_resigned for s in samples],
+                    resign_false_positive=[s.resign_false_positive for s in samples],
+                    resultant_puct_visits=[s.resultant_puct_visits for s in samples],
+                    final_score=[s.final_score for s in samples],
+                    resultant_puct_score=[s.resultant_puct_score for s in samples],
+                    match_identifier=[s.match_identifier for s in samples],
+                    depth=[s.depth for s in samples])
+
+        num_roles = len(samples[0].policies) if samples else 0
+        for ri in range(num_roles):
+            cols["policy%d_count" % ri] = [len(s.policies[ri]) for s in samples]
+
+        self.add_columns(cols, was_draws)
+
+    def add_columns(self, cols, was_draws):
+        ' as add_batch(), but from gendata columns (see gendata.sample_columns()) '
+        num_samples = len(cols["depth"])
+        if num_samples == 0:
+            return
+
+        self.num_samples += num_samples
+        self.total_draws += int(np.sum(was_draws))
+
+        # (num_samples, num_roles)
+        num_roles = sum(1 for k in cols if k.startswith("policy") and k.endswith("_count"))
+        policy_lens = np.stack([np.asarray(cols["policy%d_count" % ri])
+                                for ri in range(num_roles)], axis=1)
+        self.bare_policies += int(np.sum((policy_lens == 1).all(axis=1)))
+        for ri, count in enumerate((policy_lens[:, :2] > 1).sum(axis=0)):
+            self.total_ratio_of_roles[ri] += int(count)
+
+        self.total_resigns += int(np.sum(cols["has_resigned"]))
+        self.total_false_positives += int(np.sum(cols["resign_false_positive"]))
+        self.total_puct_visits += int(np.sum(cols["resultant_puct_visits"]))
+
+        final_scores = np.asarray(cols["final_score"], dtype=np.float64)
+        for ii, total in enumerate(final_scores.sum(axis=0)):
+            self.total_final_scores_per_roles[ii] += float(total)
+
+        # bucket is the last upper limit <= score (or the first bucket)
+        upper_limits = np.array([upper_limit for upper_limit, _ in self.total_puct_score_dist])
+        puct_scores = np.asarray(cols["resultant_puct_score"], dtype=np.float64)[:, 0]
+        buckets = np.searchsorted(upper_limits, puct_scores - 0.0001, side="right") - 1
+        counts = np.bincount(np.maximum(buckets, 0), minlength=len(upper_limits))
+        for ii, count in enumerate(counts):
+            self.total_puct_score_dist[ii][1] += int(count)
+
+        # first and last depth of each match (a match may span chunks)
+        match_ids = np.asarray(cols["match_identifier"]).tolist()
+        depths = np.asarray(cols["depth"]).tolist()
+        ids_array = np.array(match_ids)
+        _, first = np.unique(ids_array, return_index=True)
+        _, last = np.unique(ids_array[::-1], return_index=True)
+        last = num_samples - 1 - last
+
+        for first_indx, last_indx in zip(first, last):
+            match_depths = self.match_depths.get(match_ids[first_indx])
+            if match_depths is None:
+                self.match_depths[match_ids[first_indx]] = [depths[first_indx], depths[last_indx]]
+            else:
+                match_depths[1] = depths[last_indx]
+
+
+class FileIngest(object):
+    ' the results of processing a gendata file (either inline or in a sync worker process) '
+
+    def __init__(self, step, file_path, md5sum):
+        self.step = step
+        self.file_path = file_path
+        self.md5sum = md5sum
 
-            indx = ii
-        self.total_puct_score_dist[indx][1] += 1
+        # set once the file is read
+        self.with_generation = None
+        self.file_num_samples = None
+
+        self.stats = StatsAccumulator()
+
+        # time spent, samples and bytes for each stage of ingest
+        self.metrics = metrics.Metrics()
+
+
+def sync_worker(cache, ingest, queue):
+    ' runs in a forked process, see DataCache.ingest_files_parallel() '
+    try:
+        # otherwise every worker inherits the same random state
+        random.seed()
+
+        for chunk in cache.ingest_file(ingest):
+            queue.put(("chunk", chunk))
+
+        queue.put(("done", ingest))
+
+    except Exception:
+        queue.put(("error", traceback.format_exc()))
 
 
 class DataCache(object):
     # XXX data_augment_pct to replace do_augment_data
     def __init__(self, transformer, gen_prefix, do_augment_data=False,
                  data_augment_pct=1.0,
-                 score_draw_as_random_hack=False):
+                 score_draw_as_random_hack=False,
+                 ingest_chunk_size=4096,
+                 sync_workers=0,
+                 sync_queue_depth=4,
+                 packed_states=False,
+                 sparse_policies=False,
+                 deep_verify=False,
+                 db_backend="bcolz",
+                 lazy_augment=False,
+                 dedupe_states=False,
+                 compact_inputs=False):
 
         self.transformer = transformer
         self.gen_prefix = gen_prefix
@@ -450,18 +648,107 @@ class DataCache(object):
         self.data_augment_pct = data_augment_pct
         self.score_draw_as_random_hack = score_draw_as_random_hack
 
+        # number of samples converted to numpy arrays and appended to db in one go
+        self.ingest_chunk_size = ingest_chunk_size
+
+        # number of processes to decode/transform gendata files with during sync (0 is inline).
+        # each worker can be up to sync_queue_depth chunks ahead of the db.
+        self.sync_workers = sync_workers
+        self.sync_queue_depth = sync_queue_depth
+
+        # store basestates as packed bits, rather than channels.  These are expanded to channels
+        # for each batch in generate().
+        self.packed_states = packed_states
+
+        # store policies as (legal, prob) pairs in a separate table per role (the db has the
+        # start/count into the table).  These are made dense for each batch in generate().
+        self.sparse_policies = sparse_policies
+
+        # recompute md5sums of all the gendata files, rather than trusting the fingerprints
+        self.deep_verify = deep_verify
+
+        # how the db is stored (see storage.BACKENDS)
+        self.backend = storage.get_backend(db_backend)
+
+        # with do_augment_data, rather than storing every symmetry of a sample in the db, only
+        # store the sample and apply a random symmetry to it for each batch (see generate())
+        self.lazy_augment = lazy_augment
+        self.translator = self.prescription = None
+        if self.do_augment_data and self.lazy_augment:
+            assert self.packed_states, "lazy_augment requires packed_states"
+
+            game_symmetries = self.transformer.get_symmetries_desc()
+            if game_symmetries is not None:
+                self.translator = symmetry.create_translator(self.transformer.game_info,
+                                                             self.transformer.game_desc,
+                                                             game_symmetries)
+                self.prescription = list(symmetry.Prescription(game_symmetries))
+
+        # the db has a count column, the number of samples merged into each row by dedupe()
+        self.dedupe_states = dedupe_states
+        if self.dedupe_states:
+            assert self.packed_states, "dedupe_states requires packed_states"
+
+        # store channels as uint8 (or float16 if the game has fractional control channels), and
+        # create the inputs of batches as float16.  They are cast to float32 as they are fed to the
+        # network.
+        self.compact_inputs = compact_inputs
+        if self.compact_inputs:
+            self.channels_dtype = self.transformer.compact_input_dtype
+            self.inputs_dtype = np.dtype('float16')
+        else:
+            self.channels_dtype = self.inputs_dtype = np.dtype('float32')
+
         man = get_manager()
         self.data_path = man.samples_path(self.transformer.game, gen_prefix)
         self.summary_path = os.path.join(self.data_path, "gendata_summary.json")
+        self.fingerprints_path = os.path.join(self.data_path, "gendata_fingerprints.json")
 
         self.summary = self.get_summary()
         self.save_summary_file()
-        bcolz.set_nthreads(4)
 
     @property
     def total_samples(self):
         return self.summary.total_samples
 
+    @property
+    def input_names(self):
+        ' names of db columns used to create the inputs to the network '
+        if not self.packed_states:
+            return ["channels"]
+
+        if self.transformer.num_previous_states:
+            return ["state", "prev_states"]
+
+        return ["state"]
+
+    @property
+    def output_names(self):
+        ' names of db columns used to create the outputs of network '
+        names = []
+        for ri in range(self.transformer.role_count):
+            if self.sparse_policies:
+                names += ["policy%d_start" % ri, "policy%d_count" % ri]
+            else:
+                names.append("policy%d" % ri)
+
+        names.append("value")
+        return names
+
+    @property
+    def db_path(self):
+        return os.path.join(self.data_path, "__db__")
+
+    def policy_db_path(self, role_index):
+        return os.path.join(self.data_path, "__db_policy%d__" % role_index)
+
+    @property
+    def column_names(self):
+        names = self.input_names + self.output_names
+        if self.dedupe_states:
+            names.append("count")
+        return names
+
     def get_summary(self, create=False):
         if create or not os.path.exists(self.summary_path):
             summary = datadesc.GenDataSummary(game=self.transformer.game,
@@ -473,23 +760,65 @@ class DataCache(object):
 
         return summary
 
+    def get_fingerprints(self):
+        ' returns dict of path -> FileFingerprint '
+        if not os.path.exists(self.fingerprints_path):
+            return {}
+
+        try:
+            fingerprints = attrutil.json_to_attr(open(self.fingerprints_path).read())
+        except Exception as exc:
+            log.warning("Failed to read %s: %s" % (self.fingerprints_path, exc))
+            return {}
+
+        return {fp.path: fp for fp in fingerprints.fingerprints}
+
+    def save_fingerprints(self, fingerprints):
+        fingerprints = datadesc.FileFingerprints([fingerprints[k] for k in sorted(fingerprints)])
+        with open(self.fingerprints_path, 'w') as open_file:
+            open_file.write(attrutil.attr_to_json(fingerprints, pretty=True))
+
     def list_files(self):
         match_start_with = "gendata_%s_" % self.transformer.game
-        match_ends_with = ".json.gz"
+
+        # step -> file_path.  if a step has both a json and binary file (ie it was converted), the
+        # binary file is used
+        paths = {}
+        for fn in os.listdir(self.data_path):
+            if not fn.startswith(match_start_with):
+                continue
+
+            for match_ends_with in (gendata.BINARY_EXT, gendata.JSON_EXT):
+                if fn.endswith(match_ends_with):
+                    step = int(fn.replace(match_start_with, "").replace(match_ends_with, ""))
+                    file_path = os.path.join(self.data_path, fn)
+                    if step not in paths or file_path.endswith(gendata.BINARY_EXT):
+                        paths[step] = file_path
+                    break
+
+        fingerprints = self.get_fingerprints()
+        updated_fingerprints = {}
+
         # fn -> (fn, msd5sum, num_samples
         files = {}
-        for fn in os.listdir(self.data_path):
-            file_path = os.path.join(self.data_path, fn)
-            if fn.startswith(match_start_with) and fn.endswith(match_ends_with):
-                step = int(fn.replace(match_start_with, "").replace(match_ends_with, ""))
+        for step, file_path in paths.items():
+            # only compute the md5sum if the file is new or has changed
+            st = os.stat(file_path)
+            cached = fingerprints.get(file_path)
+            fp = datadesc.FileFingerprint(file_path, st.st_size, st.st_mtime, st.st_ino,
+                                          cached.md5sum if cached is not None else None)
 
-                m = hashlib.md5()
-                m.update(open(file_path).read())
-                md5sum = m.hexdigest()
+            unchanged = fp == cached
+            if not unchanged or self.deep_verify:
+                fp.md5sum = md5sum_file(file_path)
+                if unchanged and fp.md5sum != cached.md5sum:
+                    log.warning("File %s changed, but its fingerprint did not" % file_path)
 
-                assert step not in files
+            updated_fingerprints[file_path] = fp
+            files[step] = file_path, fp.md5sum
 
-                files[step] = file_path, md5sum
+        if updated_fingerprints != fingerprints:
+            self.save_fingerprints(updated_fingerprints)
 
         for step in sorted(files):
             file_path, md5sum = files[step]
@@ -503,8 +832,12 @@ class DataCache(object):
             if self.summary.game != self.transformer.game:
                 raise Check("Game not same %s/%s" % (self.summary.game, self.transformer.game))
 
-            expect = 0
-            for step_sum, (step, file_path, md5sum) in zip(self.summary.step_summaries, self.list_files()):
+            # skip any files that have been compacted out of the db
+            first_step = self.summary.first_step
+            files = (f for f in self.list_files() if f[0] >= first_step)
+
+            expect = first_step
+            for step_sum, (step, file_path, md5sum) in zip(self.summary.step_summaries, files):
 
                 # special case exception, this should never happen!
                 if step_sum.step != expect:
@@ -514,6 +847,13 @@ class DataCache(object):
                 if step_sum.step != step:
                     raise Check("step_sum(%d) != step(%d)" % (step_sum.step, step))
 
+                if step_sum.md5sum != md5sum and step_sum.filename != file_path:
+                    # the file was converted (json -> binary).  check it has the same samples.
+                    self.check_converted_file(step_sum, file_path)
+                    log.info("Summary check: step %d now from %s" % (step, file_path))
+                    step_sum.filename = file_path
+                    step_sum.md5sum = md5sum
+
                 if step_sum.md5sum != md5sum:
                     msg = "Summary check: for file %s, md5sum(%s) != md5sum(%s)" % (file_path,
                                                                                     step_sum.md5sum,
@@ -534,16 +874,38 @@ class DataCache(object):
 
         return True
 
+    def check_converted_file(self, step_sum, file_path):
+        ' raises Check, unless the header of file_path matches what was ingested for step_sum '
+        if step_sum.file_num_samples is None:
+            raise Check("step %d changed file to %s, and its samples were not recorded" % (
+                step_sum.step, file_path))
+
+        header = gendata.read_header(file_path)
+        if (header.game != self.transformer.game or
+            header.with_generation != step_sum.with_generation or
+            header.num_samples != step_sum.file_num_samples):
+            raise Check("step %d changed file to %s, which has different samples" % (step_sum.step,
+                                                                                   file_path))
+
     def verify_db(self):
-        ' checks summary against existing files '
-        db_path = os.path.join(self.data_path, "__db__")
-        if not os.path.exists(db_path):
+        ''' checks summary against existing files.  Returns False if the db needs to be rebuilt (missing
+        or a different layout), any other error accessing the db is raised. '''
+        if not os.path.exists(self.db_path):
             return False
 
         try:
-            self.db = bcolz.open(db_path, mode='a')
+            if not self.backend.is_table(self.db_path):
+                raise Check("db is not a %s table" % self.backend.name)
+
+            self.db = self.backend.open_table(self.db_path)
 
-            # XXX check columns are correct types
+            # check columns are correct types
+            if self.db.names != self.column_names:
+                raise Check("db columns %s, expected %s" % (self.db.names, self.column_names))
+
+            for name, col in zip(self.db.names, self.fake_columns()):
+                if self.db[name].dtype != col.dtype or self.db[name].shape[1:] != col.shape[1:]:
+                    raise Check("db column %s has different type/shape" % name)
 
             if self.summary.total_samples != self.db.size:
                 msg = "db and summary file different sizes summary: %s != %s" % (self.db.size,
@@ -556,31 +918,111 @@ class DataCache(object):
                 else:
                     raise Check(msg)
 
-        except Exception as exc:
-            log.error("error accessing db directory: %s" % exc)
+            if self.sparse_policies:
+                self.verify_policy_dbs()
+
+        except Check as exc:
+            log.error("db check failed: %s" % exc)
             return False
 
         return True
 
-    def create_db(self):
-        ' delete existing bcolz db (warn) and then create a fresh  '
-        db_path = os.path.join(self.data_path, "__db__")
+    def verify_policy_dbs(self):
+        self.policy_dbs = []
+        for ri in range(self.transformer.role_count):
+            if not self.backend.is_table(self.policy_db_path(ri)):
+                raise Check("policy db %d missing" % ri)
+
+            policy_db = self.backend.open_table(self.policy_db_path(ri))
+
+            # number of entries referenced by db
+            expect_size = 0
+            if self.db.size:
+                last = self.db.size - 1
+                expect_size = self.db["policy%d_start" % ri][last] + self.db["policy%d_count" % ri][last]
+
+            if policy_db.size != expect_size:
+                msg = "policy db %d and db different sizes: %s != %s" % (ri, policy_db.size, expect_size)
+                log.warning(msg)
+                if policy_db.size > expect_size:
+                    log.warning("resizing")
+                    policy_db.resize(expect_size)
+                else:
+                    raise Check(msg)
+
+            self.policy_dbs.append(policy_db)
 
-        if os.path.exists(db_path):
-            log.warning("Please delete old db")
-            sys.exit(1)
+    def reopen_db(self):
+        ''' reopens the (already verified) db and policy dbs read only.  For processes forked to
+        prepare batches, so they don't share the parent's file handles. '''
+        self.db = self.backend.open_table(self.db_path, readonly=True)
+        if self.sparse_policies:
+            self.policy_dbs = [self.backend.open_table(self.policy_db_path(ri), readonly=True)
+                               for ri in range(self.transformer.role_count)]
 
-        # these are columns for bcolz table
-        cols = fake_columns(self.transformer)
+    def readonly_copy(self):
+        ''' a copy of the cache with its own read only handles on the db (see reopen_db()), so batches
+        can be read from another thread without sharing the table with anything else. '''
+        cache = copy.copy(self)
+        cache.reopen_db()
+        return cache
+
+    def create_db(self):
+        ''' moves any existing db aside to <path>.old (warn, replacing any previous backup) and then
+        creates a fresh.  The policy dbs are moved even if not sparse_policies, as they may be left
+        from a db created with different options. '''
+        db_paths = [self.db_path]
+        db_paths += [self.policy_db_path(ri) for ri in range(self.transformer.role_count)]
+
+        for db_path in db_paths:
+            if os.path.exists(db_path):
+                log.warning("Moving old db %s to %s.old" % (db_path, db_path))
+                if os.path.exists(db_path + ".old"):
+                    shutil.rmtree(db_path + ".old")
+                os.rename(db_path, db_path + ".old")
+
+        # these are example columns for the table
+        cols = self.fake_columns()
 
         # and create a table
-        self.db = bcolz.ctable(cols, names=["channels", "policy0", "policy1", "value"], rootdir=db_path)
+        self.db = self.backend.create_table(self.db_path, cols, self.column_names)
+
+        if self.sparse_policies:
+            self.policy_dbs = []
+            for ri in range(self.transformer.role_count):
+                policy_db = self.backend.create_table(self.policy_db_path(ri),
+                                                      fake_policy_columns(), ["legal", "prob"])
+                self.policy_dbs.append(policy_db)
+
+        log.info("Created new %s db" % self.backend.name)
 
-        # remove the single row
-        self.db.resize(0)
+    def append_to_db(self, cols, policy_cols):
+        ' append a chunk of columns (from chunk_to_columns()) to the db '
+        if self.sparse_policies:
+            by_name = dict(zip(self.db.names, cols))
+            for ri, policy_db in enumerate(self.policy_dbs):
+                # starts are relative to the chunk
+                by_name["policy%d_start" % ri] += policy_db.size
+                policy_db.append(policy_cols[ri])
+
+        self.db.append(cols)
+
+    def flush_db(self):
         self.db.flush()
+        if self.sparse_policies:
+            for policy_db in self.policy_dbs:
+                policy_db.flush()
+
+    def fake_columns(self):
+        cols = fake_columns(self.transformer,
+                            packed_states=self.packed_states,
+                            sparse_policies=self.sparse_policies,
+                            channels_dtype=self.channels_dtype)
+        if self.dedupe_states:
+            cols.append(np.array([1], dtype=np.int32))
 
-        log.info("Created new db")
+        assert len(cols) == len(self.column_names)
+        return cols
 
     def files_to_process(self):
         ' generate files to process '
@@ -594,13 +1036,20 @@ class DataCache(object):
                 continue
             yield step, file_path, md5sum
 
+    @property
+    def augment_on_ingest(self):
+        ' whether every symmetry of each sample is added to the db (see augment_data()) '
+        return (self.do_augment_data and not self.lazy_augment and
+                self.transformer.get_symmetries_desc() is not None)
+
     def augment_data(self, samples):
-        game_symmetries = self.transformer.get_symmetries_desc()
-        if not self.do_augment_data or game_symmetries is None:
+        if not self.augment_on_ingest:
             for sample in samples:
                 yield sample
             return
 
+        game_symmetries = self.transformer.get_symmetries_desc()
+
         t = symmetry.create_translator(self.transformer.game_info,
                                        self.transformer.game_desc,
                                        game_symmetries)
@@ -609,27 +1058,25 @@ class DataCache(object):
         def translate_policies(policies, do_reflection, rot_count):
             new_policies = []
             for role_index, policy in enumerate(policies):
-                role_policy = []
+                if not policy:
+                    new_policies.append([])
+                    continue
 
-                # get the action from the model
-                for legal, p in policy:
-                    translated_legal = t.translate_action(role_index, legal, do_reflection, rot_count)
-                    role_policy.append((translated_legal, p))
+                legals, probs = zip(*policy)
+                legals = t.translate_legals(role_index, np.array(legals), do_reflection, rot_count)
+                new_policies.append(zip(legals.tolist(), probs))
 
-                new_policies.append(role_policy)
             return new_policies
 
-        def decode_state2(encoded):
-            state = fast_decode_state(encoded)
-            return state[:len(t.base_symbols)]
+        num_bases = len(t.base_symbols)
 
         # go through each samples
         count = 0
         for sample in samples:
             count += 1
 
-            decoded_state = decode_state2(sample.state)
-            decoded_prev_states = [decode_state2(s) for s in sample.prev_states]
+            # state and prev_states as rows of one array, so translated together
+            decoded_states = decode_states([sample.state] + list(sample.prev_states), num_bases)
 
             seen = set()
             for do_reflection, rot_count in prescription:
@@ -640,17 +1087,16 @@ class DataCache(object):
                     continue
 
                 # translate states/policies
-                state = t.translate_basestate_faster(decoded_state, do_reflection, rot_count)
+                states = t.translate_basestates(decoded_states, do_reflection, rot_count)
 
                 # dont do duplicates
-                state = tuple(state)
-
-                if state in seen:
+                key = states[0].tostring()
+                if key in seen:
                     continue
-                seen.add(state)
+                seen.add(key)
 
-                prev_states = [t.translate_basestate_faster(s, do_reflection, rot_count)
-                               for s in decoded_prev_states]
+                state = tuple(states[0].tolist())
+                prev_states = [s.tolist() for s in states[1:]]
                 policies = translate_policies(sample.policies, do_reflection, rot_count)
 
                 match_identifier = "%s_+%d_+%d" % (sample.match_identifier, do_reflection, rot_count)
@@ -670,133 +1116,255 @@ class DataCache(object):
                                       resultant_puct_score=sample.resultant_puct_score[:],
                                       resultant_puct_visits=sample.resultant_puct_visits)
 
-    def sync(self):
-        # check summary matches current set of files
-        if not self.check_summary() or not self.verify_db():
-            self.get_summary(create=True)
-            self.create_db()
+    def alloc_columns(self, num_samples):
+        ' preallocate numpy arrays matching the db columns, for num_samples rows '
+        return [np.zeros((num_samples,) + self.db[name].shape[1:], dtype=self.db[name].dtype)
+                for name in self.db.names]
+
+    def prepare_columns(self, chunk):
+        ' clamps final scores (in place), and returns whether each sample was a draw '
+        final_scores = chunk["final_score"] = np.clip(chunk["final_score"], 0.0, 1.0)
+
+        was_draws = np.abs(final_scores[:, 0] - 0.5) < 0.01
+        assert (np.abs(final_scores[was_draws, 1] - 0.5) < 0.01).all()
+
+        # XXX highly experimental
+        if self.score_draw_as_random_hack:
+            # the idea is just to randomly asign a win or loss to train on.  Then the
+            # network can average out over a 'bazillion' draw samples and determine that
+            # the value should be 0.5.  In theory.  XXX Who knows?
+            for indx in np.nonzero(was_draws)[0]:
+                if random.random() > 0.5:
+                    final_scores[indx] = [1.0, 0]
+                else:
+                    final_scores[indx] = [0, 1.0]
+
+        return was_draws
+
+    def chunk_to_columns(self, chunk, stats, stage_metrics):
+        ''' converts a chunk of samples (as columns, see gendata.sample_columns()) to preallocated
+        column arrays (in the order of db.names).  returns cols, policy_cols (where policy_cols is
+        the policy table columns per role, for sparse policies, otherwise None) '''
+
+        t = self.transformer
+        num_samples = len(chunk["state"])
+        cols = self.alloc_columns(num_samples)
+        by_name = dict(zip(self.db.names, cols))
+
+        timer = stage_metrics.timer()
+        was_draws = self.prepare_columns(chunk)
+
+        stats.add_columns(chunk, was_draws)
+        timer.lap("stats")
+
+        # states are packed bits (possibly padded).  missing previous states are all zeros (which is
+        # the same as not existing)
+        states = chunk["state"]
+        num_prev = min(t.num_previous_states, chunk["prev_states"].shape[1])
+        prev_states = chunk["prev_states"][:, :num_prev]
+
+        if self.packed_states:
+            # no need to decode, state can be stored as is
+            by_name["state"][:] = states[:, :t.num_packed_bytes]
+            if num_prev:
+                by_name["prev_states"][:, :num_prev] = prev_states[..., :t.num_packed_bytes]
+
+            timer.lap("decode")
+
+        else:
+            states = np.unpackbits(states, axis=-1)
+            prev_matrix = None
+            if t.num_previous_states:
+                prev_matrix = np.zeros((num_samples, t.num_previous_states, states.shape[1]),
+                                       dtype=np.uint8)
+                prev_matrix[:, :num_prev] = np.unpackbits(prev_states, axis=-1)
+
+            timer.lap("decode")
+
+            # already contiguous and in the layout of the db, so use as the column without a copy
+            channels = t.states_to_channels(states, prev_matrix, dtype=self.channels_dtype)
+            by_name["channels"] = cols[self.db.names.index("channels")] = channels
+            timer.lap("channels")
+
+        # policies of the chunk are in CSR form, the (legal, prob) pairs of each role concatenated
+        policy_cols = [] if self.sparse_policies else None
+        for ri in range(t.role_count):
+            counts = chunk["policy%d_count" % ri]
+            legals = chunk["policy%d_legal" % ri]
+            probs = chunk["policy%d_prob" % ri]
+
+            if self.sparse_policies:
+                by_name["policy%d_start" % ri][:] = np.cumsum(counts) - counts
+                by_name["policy%d_count" % ri][:] = counts
+                policy_cols.append([legals, probs])
+            else:
+                by_name["policy%d" % ri][:] = t.policies_to_array(legals, probs, counts, ri)
+
+        by_name["value"][:] = t.values_to_array(chunk["final_score"])
+        timer.lap("outputs")
+
+        if self.dedupe_states:
+            by_name["count"][:] = 1
+
+        # the inputs are written by the last stage that touches them
+        input_bytes = sum(by_name[name].nbytes for name in self.input_names)
+        output_bytes = sum(by_name[name].nbytes for name in self.output_names)
+        if policy_cols is not None:
+            output_bytes += sum(col.nbytes for cols in policy_cols for col in cols)
+
+        stage_metrics.add("stats", samples=num_samples)
+        if self.packed_states:
+            stage_metrics.add("decode", samples=num_samples, bytes_written=input_bytes)
+        else:
+            stage_metrics.add("decode", samples=num_samples)
+            stage_metrics.add("channels", samples=num_samples, bytes_written=input_bytes)
+
+        stage_metrics.add("outputs", samples=num_samples, bytes_written=output_bytes)
+
+        return cols, policy_cols
+
+    def ingest_file(self, ingest):
+        ''' generator, reads a gendata file and yields chunks (see chunk_to_columns()).  Updates
+        ingest as it goes. '''
+        log.debug("Processing %s" % ingest.file_path)
+
+        # json files are streamed in, so only ingest_chunk_size samples are held in memory at a time
+        reader = gendata.get_reader(ingest.file_path)
+
+        # process in chunks, so each chunk can be appended to db in one operation.  Samples are only
+        # created if augmenting, otherwise chunks are read as columns.
+        if self.augment_on_ingest:
+            chunks = (gendata.sample_columns(samples) for samples in
+                      func.ichunks(self.augment_data(reader), self.ingest_chunk_size))
+        else:
+            chunks = reader.iter_column_chunks(self.ingest_chunk_size)
+
+        timer = ingest.metrics.timer()
+        for chunk in chunks:
+            # reading the file, decoding the json/columns (and augmenting)
+            timer.lap("read")
+            ingest.metrics.add("read", samples=len(chunk["state"]))
+
+            yield self.chunk_to_columns(chunk, ingest.stats, ingest.metrics)
+
+            # don't include time spent by the consumer
+            timer = ingest.metrics.timer()
+
+        timer.lap("read")
+        ingest.metrics.add("read", bytes_read=os.path.getsize(ingest.file_path))
 
-        for step, file_path, md5sum in self.files_to_process():
+        data = reader.header
+        log.debug("Game %s, with gen: %s and sample count %s" % (data.game,
+                                                                 data.with_generation,
+                                                                 data.num_samples))
+
+        ingest.with_generation = data.with_generation
+        ingest.file_num_samples = data.num_samples
+
+    def ingest_files(self, files):
+        ' yields (ingest, chunk) for each chunk, and (ingest, None) when a file is complete '
+        for step, file_path, md5sum in files:
             # lets delete any spurious memory
             gc.collect()
 
-            log.debug("Processing %s" % file_path)
-            data = attrutil.json_to_attr(gzip.open(file_path).read())
-
-            if len(data.samples) != data.num_samples:
-                # pretty inconsequential, but we should at least notify
-                msg = "num_samples (%d) versus actual samples (%s) differ... trimming"
-                log.warning(msg % (data.num_samples, len(data.samples)))
-
-                data.num_samples = min(len(data.samples), data.num_samples)
-                data.samples = data.samples[:data.num_samples]
-
-            log.debug("Game %s, with gen: %s and sample count %s" % (data.game,
-                                                                     data.with_generation,
-                                                                     data.num_samples))
-
-            indx = self.db.size
-            stats = StatsAccumulator()
-            t = self.transformer
-
-            # ZZZ really slow
-            # ZZZ profile/gather times in loop... (guessing the time is in decoding state)
-            time_check = 0
-            time_stats = 0
-            time_decode = 0
-            time_decode_prevs = 0
-            time_channels = 0
-            time_outputs = 0
-            time_db_resize = 0
-            time_db_insert = 0
-
-            cur_size = indx
-
-            for sample in self.augment_data(data.samples):
-                # ensure that final scores are clamped before adding to db
-                sample.final_score = [min(1.0, v) for v in sample.final_score]
-                sample.final_score = [max(0.0, v) for v in sample.final_score]
-
-                sample_is_draw = False
-                if abs(sample.final_score[0] - 0.5) < 0.01:
-                    assert abs(sample.final_score[1] - 0.5) < 0.01
-                    sample_is_draw = True
-
-                # XXX highly experimental
-                if sample_is_draw and self.score_draw_as_random_hack:
-                    # the idea is just to randomly asign a win or loss to train on.  Then the
-                    # network can average out over a 'bazillion' draw samples and determine that
-                    # the value should be 0.5.  In theory.  XXX Who knows?
-
-                    if random.random() > 0.5:
-                        sample.final_score = [1.0, 0]
-                    else:
-                        sample.final_score = [0, 1.0]
+            ingest = FileIngest(step, file_path, md5sum)
+            for chunk in self.ingest_file(ingest):
+                yield ingest, chunk
 
-                et = ElaspedTime()
+            yield ingest, None
 
-                # XXX too slow, and only useful for debugging serious bugs - disable
-                # t.check_sample(sample)
-                time_check += et.update()
+    def ingest_files_parallel(self, files, num_workers):
+        ''' same as ingest_files(), but files are processed by num_workers forked processes.  The
+        chunks are still yielded in file order, so the parent can append them to db as if serial. '''
 
-                stats.add(sample, was_draw=sample_is_draw)
-                time_stats += et.update()
+        pending = list(files)
+        running = []
 
-                # add channels
+        def start_next():
+            step, file_path, md5sum = pending.pop(0)
+            ingest = FileIngest(step, file_path, md5sum)
 
-                # only decode if not already decoded (as in the case of augmentation)
-                state = fast_decode_state(sample.state)
+            # bounded, so workers ahead of the parent don't fill up memory
+            queue = multiprocessing.Queue(self.sync_queue_depth)
+            proc = multiprocessing.Process(target=sync_worker, args=(self, ingest, queue))
+            proc.daemon = True
+            proc.start()
+            running.append((ingest, proc, queue))
 
-                time_decode += et.update()
-
-                prev_states = [fast_decode_state(s) for s in sample.prev_states]
+        try:
+            while pending or running:
+                while pending and len(running) < num_workers:
+                    start_next()
+
+                ingest, proc, queue = running.pop(0)
+                while True:
+                    what, payload = queue.get()
+                    if what == "chunk":
+                        yield ingest, payload
+
+                    elif what == "done":
+                        # the worker's copy has the stats/metrics filled in, and ours has the time
+                        # spent inserting into the db
+                        payload.metrics.merge(ingest.metrics)
+                        payload.metrics.time_started = ingest.metrics.time_started
+                        ingest = payload
+                        break
 
-                time_decode_prevs += et.update()
+                    else:
+                        raise Exception("sync worker failed for %s:\n%s" % (ingest.file_path, payload))
 
-                cols = [t.state_to_channels(state, prev_states)]
-                time_channels += et.update()
+                proc.join()
+                yield ingest, None
 
-                for ri, policy in enumerate(sample.policies):
-                    cols.append(t.policy_to_array(policy, ri))
+        finally:
+            for _, proc, _ in running:
+                proc.terminate()
 
-                time_outputs += et.update()
+    def sync(self, num_workers=None):
+        if num_workers is None:
+            num_workers = self.sync_workers
 
-                cols.append(t.value_to_array(sample.final_score))
+        # check summary matches current set of files
+        if not self.check_summary() or not self.verify_db():
+            self.summary = self.get_summary(create=True)
+            self.create_db()
 
-                # is this an efficient way to do things?
-                if indx >= cur_size:
-                    cur_size += 20
-                    self.db.resize(cur_size)
+        files = list(self.files_to_process())
+        if num_workers > 1 and len(files) > 1:
+            log.info("Syncing %d files with %d workers" % (len(files), num_workers))
+            ingester = self.ingest_files_parallel(files, num_workers)
+        else:
+            ingester = self.ingest_files(files)
 
-                time_db_resize += et.update()
-                for ii, name in enumerate(self.db.names):
-                    self.db[name][indx] = cols[ii]
+        for ingest, chunk in ingester:
+            if chunk is not None:
+                cols, policy_cols = chunk
+                num_bytes = sum(col.nbytes for col in cols)
+                if policy_cols is not None:
+                    num_bytes += sum(col.nbytes for pcols in policy_cols for col in pcols)
 
-                indx += 1
-                time_db_insert += et.update()
+                et = ElaspedTime()
+                self.append_to_db(cols, policy_cols)
+                ingest.metrics.add("db_insert", et.update(),
+                                   samples=len(cols[0]), bytes_written=num_bytes)
+                continue
 
-            print "time_check: %.2f" % time_check
-            print "time_stats: %.2f" % time_stats
-            print "time_decode: %.2f" % time_decode
-            print "time_decode_prevs: %.2f" % time_decode_prevs
-            print "time_channels: %.2f" % time_channels
-            print "time_outputs: %.2f" % time_outputs
-            print "time_db_resize: %.2f" % time_db_resize
-            print "time_db_insert: %.2f" % time_db_insert
+            # file is complete
+            stats = ingest.stats
 
-            if indx != cur_size:
-                cur_size = indx
-                self.db.resize(indx)
+            et = ElaspedTime()
+            self.flush_db()
+            ingest.metrics.add("db_insert", et.update())
 
-            self.db.flush()
+            self.save_ingest_metrics(ingest)
             log.debug("Added %d samples to db" % stats.num_samples)
 
             # add to the summary and save it
-            step_sum = datadesc.StepSummary(step=step,
-                                            filename=file_path,
-                                            with_generation=data.with_generation,
+            step_sum = datadesc.StepSummary(step=ingest.step,
+                                            filename=ingest.file_path,
+                                            with_generation=ingest.with_generation,
                                             num_samples=stats.num_samples,
-                                            md5sum=md5sum,
+                                            md5sum=ingest.md5sum,
                                             stats_unique_matches=stats.unique_matches,
                                             stats_draw_ratio=stats.draw_ratio,
                                             stats_bare_policies_ratio=stats.bare_policies_ratio,
@@ -807,7 +1375,8 @@ class DataCache(object):
                                             stats_av_puct_visits=stats.av_puct_visits,
                                             stats_ratio_of_roles=stats.ratio_of_roles,
                                             stats_av_final_scores=stats.av_final_scores,
-                                            stats_av_puct_score_dist=stats.av_puct_score_dist)
+                                            stats_av_puct_score_dist=stats.av_puct_score_dist,
+                                            file_num_samples=ingest.file_num_samples)
 
             print attrutil.attr_to_json(step_sum, pretty=True)
 
@@ -823,29 +1392,572 @@ class DataCache(object):
         self.save_summary_file()
         log.info("Data cache synced, saved summary file.")
 
+    def compact(self, buckets, starting_step=None):
+        ''' drops the oldest steps that buckets will never sample from (ie those outside the replay
+        window), rewriting the db without them.  The window counts back from starting_step (the step
+        being trained at, see ChunkIndexer.find_levels()), or the last step if None.  Steps after
+        starting_step are kept.  Returns the number of steps dropped. '''
+        assert isinstance(buckets, Buckets)
+
+        window = buckets.window()
+        if window is None:
+            return 0
+
+        step_summaries = self.summary.step_summaries
+        num_levels = len(step_summaries)
+        if starting_step is not None:
+            num_levels = sum(1 for s in step_summaries if s.step <= starting_step)
+
+        if num_levels <= window:
+            return 0
+
+        if not self.check_summary() or not self.verify_db():
+            raise Exception("Data cache is not valid, sync() before compacting")
+
+        num_drop = num_levels - window
+        drop_summaries, keep_summaries = step_summaries[:num_drop], step_summaries[num_drop:]
+        start = sum(s.num_samples for s in drop_summaries)
+
+        log.info("Compacting db: dropping steps %d-%d (%d samples)" % (drop_summaries[0].step,
+                                                                      drop_summaries[-1].step,
+                                                                      start))
+
+        # (table, path, first row to keep, transform)
+        tables = []
+
+        policy_starts = []
+        if self.sparse_policies:
+            for ri, policy_db in enumerate(self.policy_dbs):
+                if start < self.db.size:
+                    policy_start = int(self.db["policy%d_start" % ri][start])
+                else:
+                    policy_start = policy_db.size
+
+                policy_starts.append(policy_start)
+                tables.append((policy_db, self.policy_db_path(ri), policy_start, None))
+
+        def transform(cols):
+            # starts into the policy dbs are shifted by the dropped entries
+            by_name = dict(zip(self.db.names, cols))
+            for ri, policy_start in enumerate(policy_starts):
+                by_name["policy%d_start" % ri] -= policy_start
+
+        tables.insert(0, (self.db, self.db_path, start, transform))
+
+        # write the new tables beside the existing ones, and then swap them in
+        for table, path, first_row, fn in tables:
+            compact_path = path + ".compact"
+            if os.path.exists(compact_path):
+                shutil.rmtree(compact_path)
+
+            storage.copy_table(self.backend, table, compact_path, first_row, fn)
+
+        self.swap_in_tables([path for _, path, _, _ in tables], ".compact")
+
+        self.summary.first_step = keep_summaries[0].step
+        self.summary.step_summaries = keep_summaries
+        self.summary.total_samples -= start
+        self.summary.last_updated = timestamp()
+        self.save_summary_file()
+
+        # reopen the db
+        if not self.verify_db():
+            raise Exception("Failed to reopen db after compacting")
+
+        log.info("Compacted db: %d steps, %d samples" % (len(keep_summaries),
+                                                         self.summary.total_samples))
+        return len(drop_summaries)
+
+    def swap_in_tables(self, paths, suffix):
+        ''' replaces the tables at paths with those at path + suffix.  if interrupted part way
+        through, the db and summary will disagree - and the db will be rebuilt on the next sync. '''
+        for path in paths:
+            # a backup left by create_db() is superseded by the compacted tables
+            if os.path.exists(path + ".old"):
+                shutil.rmtree(path + ".old")
+
+            os.rename(path, path + ".old")
+            os.rename(path + suffix, path)
+            shutil.rmtree(path + ".old")
+
+    def state_keys(self, start=0, chunk_rows=65536):
+        ' a key for each row of the db from start, the bytes of its packed state and previous states '
+        cols = []
+        for name in self.input_names:
+            col = self.db[name]
+            row_bytes = int(np.prod(col.shape[1:]))
+            cols.append(np.concatenate([np.zeros((0, row_bytes), dtype=col.dtype)] +
+                                       [np.asarray(col[ii:ii + chunk_rows]).reshape(-1, row_bytes)
+                                        for ii in range(start, self.db.size, chunk_rows)]))
+
+        keys = np.ascontiguousarray(np.hstack(cols))
+        return keys.view(np.dtype((np.void, keys.shape[1]))).ravel()
+
+    def merge_duplicates(self, dup_rows, groups, chunk_rows=4096):
+        ''' for each group of duplicate rows, the total count and average (dense) policies and
+        value - weighted by the count of each row.  groups is the group index of each of dup_rows.
+        returns counts, outputs (where outputs are as record_to_outputs()). '''
+        num_groups = groups.max() + 1
+        counts = self.db["count"][:][dup_rows]
+        totals = np.bincount(groups, weights=counts, minlength=num_groups)
+
+        sums = None
+        for ii in range(0, len(dup_rows), chunk_rows):
+            rows = dup_rows[ii:ii + chunk_rows]
+            outputs = self.record_to_outputs(self.db[rows.tolist()])
+            if sums is None:
+                sums = [np.zeros((num_groups,) + o.shape[1:], dtype=np.float64) for o in outputs]
+
+            weights = counts[ii:ii + chunk_rows].astype(np.float64)
+            for total, output in zip(sums, outputs):
+                weights_shape = (len(rows),) + (1,) * (output.ndim - 1)
+                np.add.at(total, groups[ii:ii + chunk_rows], output * weights.reshape(weights_shape))
+
+        averages = []
+        for total, dtype in zip(sums, [o.dtype for o in outputs]):
+            totals_shape = (num_groups,) + (1,) * (total.ndim - 1)
+            averages.append((total / totals.reshape(totals_shape)).astype(dtype))
+
+        return totals.astype(np.int32), averages
+
+    def dedupe(self, chunk_rows=4096):
+        ''' merges rows of a step with the same state (and previous states) into one row, at the
+        position of the most recent of them.  The merged row's policies and value are the average
+        of the rows (weighted by their count) and its count is the total.  Rows are never merged
+        across steps, so each step (and its training/validation split) only has its own samples.
+        Only the steps after summary.deduped_step are merged, and the db is rewritten from the
+        first of them.  Returns the number of rows removed. '''
+        assert self.dedupe_states
+
+        if not self.check_summary() or not self.verify_db():
+            raise Exception("Data cache is not valid, sync() before deduping")
+
+        new_summaries = [s for s in self.summary.step_summaries
+                         if s.step > self.summary.deduped_step]
+        if not new_summaries:
+            return 0
+
+        start = self.summary.total_samples - sum(s.num_samples for s in new_summaries)
+        num_rows = self.db.size - start
+
+        # group the rows by state and step.  unique on the reversed keys, so the row kept for each
+        # group is its most recent.
+        _, state_groups = np.unique(self.state_keys(start)[::-1], return_inverse=True)
+        steps = np.repeat(np.arange(len(new_summaries)), [s.num_samples for s in new_summaries])
+        group_keys = state_groups * len(new_summaries) + steps[::-1]
+        _, first_reversed, inverse = np.unique(group_keys, return_index=True, return_inverse=True)
+
+        keep_rows = np.sort(num_rows - 1 - first_reversed)
+        if len(keep_rows) < num_rows:
+            row_groups = inverse[::-1]
+
+            # only the rows with duplicates need merging, renumber their groups from 0
+            group_sizes = np.bincount(row_groups)
+            dup_rows = np.nonzero(group_sizes[row_groups] > 1)[0]
+            dup_groups, groups = np.unique(row_groups[dup_rows], return_inverse=True)
+            merged_counts, merged_outputs = self.merge_duplicates(dup_rows + start, groups)
+
+            # row -> index into the merged outputs (for the rows that are kept)
+            merged_index = np.full(num_rows, -1, dtype=np.int64)
+            merged_index[num_rows - 1 - first_reversed[dup_groups]] = np.arange(len(dup_groups))
+
+            log.info("Dedupe: steps %d-%d, merging %d samples into %d, %d samples removed" % (
+                new_summaries[0].step, new_summaries[-1].step,
+                len(dup_rows), len(dup_groups), num_rows - len(keep_rows)))
+
+            self.rewrite_deduped_rows(start, keep_rows, merged_index, merged_counts,
+                                      merged_outputs, chunk_rows)
+
+            # the steps keep their stats (they are of the gendata file), only the number of
+            # samples in the db changes
+            kept_per_step = np.bincount(steps[keep_rows], minlength=len(new_summaries))
+            for step_sum, num_samples in zip(new_summaries, kept_per_step):
+                step_sum.num_samples = int(num_samples)
+
+            self.summary.total_samples = start + len(keep_rows)
+
+        else:
+            log.info("Dedupe: no duplicate states in steps %d-%d" % (new_summaries[0].step,
+                                                                     new_summaries[-1].step))
+
+        self.summary.deduped_step = new_summaries[-1].step
+        self.summary.last_updated = timestamp()
+        self.save_summary_file()
+
+        # reopen the db
+        if not self.verify_db():
+            raise Exception("Failed to reopen db after deduping")
+
+        return num_rows - len(keep_rows)
+
+    def rewrite_deduped_rows(self, start, keep_rows, merged_index, merged_counts, merged_outputs,
+                             chunk_rows):
+        ''' replaces the rows of the db from start with keep_rows (relative to start), merged as
+        dedupe().  The new rows are prepared before the db is touched.  If interrupted while
+        writing, the db and summary will disagree - and the db will be rebuilt on the next sync. '''
+        policy_dbs, policy_starts = [], []
+        if self.sparse_policies:
+            policy_dbs = self.policy_dbs
+            policy_starts = [int(self.db["policy%d_start" % ri][start])
+                             for ri in range(self.transformer.role_count)]
+
+        chunks = []
+        policy_sizes = list(policy_starts)
+        for ii in range(0, len(keep_rows), chunk_rows):
+            rows = keep_rows[ii:ii + chunk_rows]
+            record = self.db[(rows + start).tolist()]
+            outputs = self.record_to_outputs(record)
+
+            indx = merged_index[rows]
+            merged = np.nonzero(indx >= 0)[0]
+            record["count"][merged] = merged_counts[indx[merged]]
+            for output, merged_output in zip(outputs, merged_outputs):
+                output[merged] = merged_output[indx[merged]]
+
+            by_name = dict((name, record[name]) for name in self.db.names)
+            by_name["value"] = outputs[-1]
+
+            policy_cols = []
+            for ri in range(self.transformer.role_count):
+                if not self.sparse_policies:
+                    by_name["policy%d" % ri] = outputs[ri]
+                    continue
+
+                # store the (legal, prob) pairs of the non zero probabilities
+                policy_rows, legals = np.nonzero(outputs[ri])
+                counts = np.bincount(policy_rows, minlength=len(rows))
+                by_name["policy%d_count" % ri] = counts.astype(np.int32)
+                by_name["policy%d_start" % ri] = np.cumsum(counts) - counts + policy_sizes[ri]
+                policy_sizes[ri] += len(legals)
+                policy_cols.append([legals.astype(np.int32),
+                                    outputs[ri][policy_rows, legals].astype(np.float32)])
+
+            chunks.append(([by_name[name] for name in self.db.names], policy_cols))
+
+        self.db.resize(start)
+        for policy_db, policy_start in zip(policy_dbs, policy_starts):
+            policy_db.resize(policy_start)
+
+        for cols, policy_cols in chunks:
+            self.db.append(cols)
+            for policy_db, pcols in zip(policy_dbs, policy_cols):
+                policy_db.append(pcols)
+
+        self.flush_db()
+
+    @property
+    def metrics_path(self):
+        return os.path.join(self.data_path, "gendata_metrics.jsonl")
+
+    def get_ingest_metrics(self):
+        ' returns the IngestMetricsHistory (all the ingests recorded for this data cache) '
+        history = datadesc.IngestMetricsHistory()
+        if not os.path.exists(self.metrics_path):
+            return history
+
+        for line in open(self.metrics_path):
+            try:
+                history.ingests.append(attrutil.json_to_attr(line))
+            except Exception as exc:
+                log.warning("Skipping bad line in %s: %s" % (self.metrics_path, exc))
+
+        return history
+
+    def save_ingest_metrics(self, ingest):
+        ' logs the metrics of an ingested file, and appends them to the metrics file '
+        m = datadesc.IngestMetrics(step=ingest.step,
+                                   filename=ingest.file_path,
+                                   date_created=timestamp(),
+                                   num_samples=ingest.stats.num_samples,
+                                   wall_seconds=ingest.metrics.wall_seconds,
+                                   config=dict(packed_states=self.packed_states,
+                                               sparse_policies=self.sparse_policies,
+                                               db_backend=self.backend.name,
+                                               do_augment_data=self.do_augment_data,
+                                               lazy_augment=self.lazy_augment,
+                                               ingest_chunk_size=self.ingest_chunk_size,
+                                               sync_workers=self.sync_workers,
+                                               compact_inputs=self.compact_inputs),
+                                   stages=ingest.metrics.stages)
+
+        log.info("Ingested step %d, %d samples in %.2fs (%.1f samples/s)" % (
+            m.step, m.num_samples, m.wall_seconds, metrics.rate(m.num_samples, m.wall_seconds)))
+        for line in ingest.metrics.report():
+            log.info(line)
+
+        # one line per ingest, so the existing history is never reread/rewritten
+        with open(self.metrics_path, 'a') as open_file:
+            open_file.write(attrutil.attr_to_json(m) + "\n")
+
     def save_summary_file(self):
         with open(self.summary_path, 'w') as open_file:
             open_file.write(attrutil.attr_to_json(self.summary, pretty=True))
 
-    def create_chunk_indexer(self, buckets, **kwds):
+    def create_chunk_indexer(self, buckets, window_chunks=0, **kwds):
         assert isinstance(buckets, Buckets)
-        indexer = ChunkIndexer(buckets, self.summary.step_summaries)
+
+        chunk_len = None
+        if window_chunks > 0:
+            chunk_len = min(self.backend.chunk_len(self.db, name) for name in self.db.names)
+
+        indexer = ChunkIndexer(buckets, self.summary.step_summaries,
+                               chunk_len=chunk_len, window_chunks=window_chunks)
         indexer.find_levels(**kwds)
         return indexer
 
-    def generate(self, indices, batch_size):
-        for ii in range(0, len(indices), batch_size):
-            next_indices = indices[ii:ii + batch_size]
+    def record_to_inputs(self, record):
+        ' inputs to network from a record of db rows '
+        if not self.packed_states:
+            return record["channels"].astype(self.inputs_dtype, copy=False)
+
+        prev_states = record["prev_states"] if self.transformer.num_previous_states else None
+        return self.transformer.packed_states_to_channels(record["state"], prev_states,
+                                                          dtype=self.inputs_dtype)
+
+    def record_to_outputs(self, record):
+        ' outputs of network (policies and value) from a record of db rows '
+        if not self.sparse_policies:
+            return [record[name] for name in self.output_names]
 
-            record = self.db[next_indices]
+        outputs = []
+        for ri, policy_db in enumerate(self.policy_dbs):
+            starts = record["policy%d_start" % ri]
+            counts = record["policy%d_count" % ri]
 
-            inputs = record["channels"]
-            outputs = [record[name] for name in self.db.names[1:]]
+            # positions into policy db of all the entries, in one gather
+            offsets = np.cumsum(counts) - counts
+            positions = np.arange(counts.sum()) + np.repeat(starts - offsets, counts)
 
-            # comment out for some extra debugging
-            # if ii == 0:
-            #    for x in 50, 250, 500:
-            #        print "inputs", inputs[x]
-            #        print "outputs", [o[x] for o in outputs]
+            entries = policy_db[positions]
+            outputs.append(self.transformer.policies_to_array(entries["legal"], entries["prob"],
+                                                              counts, ri))
 
-            yield inputs, outputs
+        outputs.append(record["value"])
+        return outputs
+
+    def lazy_augment_batch(self, record, outputs):
+        ''' applies a random symmetry (from the prescription) to each sample of the batch.  The
+        packed states of record are translated in place, as are the policies in outputs. '''
+        t = self.translator
+        num_bases = len(t.base_symbols)
+        num_samples = len(record)
+
+        choices = np.random.randint(len(self.prescription), size=num_samples)
+
+        # only do X% of translations...
+        choices[np.random.random(num_samples) > self.data_augment_pct] = 0
+
+        states = [np.unpackbits(record[name], axis=-1)[..., :num_bases] for name in self.input_names]
+
+        for choice, (do_reflection, rot_count) in enumerate(self.prescription):
+            if not do_reflection and rot_count == 0:
+                continue
+
+            rows = np.nonzero(choices == choice)[0]
+            if not len(rows):
+                continue
+
+            for s in states:
+                s[rows] = t.translate_basestates(s[rows], do_reflection, rot_count)
+
+            for ri in range(self.transformer.role_count):
+                outputs[ri][rows] = t.translate_policies(ri, outputs[ri][rows],
+                                                         do_reflection, rot_count)
+
+        for name, s in zip(self.input_names, states):
+            record[name] = np.packbits(s, axis=-1)
+
+    def get_batch(self, indices, augment=False):
+        ''' returns inputs, outputs for the db rows at indices.  if augment (and lazy_augment), a
+        random symmetry is applied to each sample. '''
+        # read the rows in db order, so each chunk is decompressed (at most) once per batch.  Then
+        # put them back in the order asked for.
+        indices = np.asarray(indices)
+        order = np.argsort(indices, kind="mergesort")
+        record = self.db[indices[order].tolist()]
+        record[order] = record.copy()
+
+        outputs = self.record_to_outputs(record)
+        if augment and self.translator is not None:
+            self.lazy_augment_batch(record, outputs)
+
+        inputs = self.record_to_inputs(record)
+
+        # comment out for some extra debugging
+        #    for x in 50, 250, 500:
+        #        print "inputs", inputs[x]
+        #        print "outputs", [o[x] for o in outputs]
+
+        return inputs, outputs
+
+    def gather(self, indices, batch_size=4096):
+        ' inputs, outputs for all the db rows at indices, as contiguous arrays '
+        if len(indices) == 0:
+            # no rows (eg no validation samples), the arrays are still shaped as a batch
+            cols = fake_columns(self.transformer, channels_dtype=self.inputs_dtype)
+            return cols[0][:0], [col[:0] for col in cols[1:]]
+
+        batches = list(self.generate(indices, batch_size))
+        inputs = np.concatenate([inputs for inputs, _ in batches])
+        outputs = [np.concatenate([o[ii] for _, o in batches]) for ii in range(len(batches[0][1]))]
+        return inputs, outputs
+
+    def resident_set_path(self, cache_key):
+        ''' path of a saved resident set.  The name is a hash of what is in the db (the summary) and
+        cache_key (how its indices were chosen). '''
+        md5 = hashlib.md5()
+        md5.update(repr((self.column_names, self.inputs_dtype.str,
+                         self.summary.first_step, self.summary.total_samples,
+                         [(s.step, s.md5sum, s.num_samples) for s in self.summary.step_summaries],
+                         cache_key)))
+        return os.path.join(self.data_path, "__resident_%s__.npz" % md5.hexdigest())
+
+    def resident_set(self, indices_fn, cache_key=None):
+        ''' gathers the samples of the indices returned by indices_fn() into memory (eg for a
+        validation set, used every epoch).  if cache_key, the set is saved in the data path and
+        loaded (without calling indices_fn) while the db and cache_key are unchanged.  returns
+        indices, inputs, outputs. '''
+        path = None
+        if cache_key is not None:
+            path = self.resident_set_path(cache_key)
+            if os.path.exists(path):
+                try:
+                    # copies the arrays out, so the file is closed
+                    with np.load(path) as arrays:
+                        num_outputs = len(arrays.files) - 2
+                        result = (arrays["indices"], arrays["inputs"],
+                                  [arrays["output%d" % ii] for ii in range(num_outputs)])
+
+                    log.info("Loaded resident set %s" % path)
+                    return result
+                except Exception as exc:
+                    log.warning("Failed to load resident set %s: %s" % (path, exc))
+
+        indices = indices_fn()
+        inputs, outputs = self.gather(indices)
+
+        if path is not None:
+            # only keep the latest
+            for fn in os.listdir(self.data_path):
+                if fn.startswith("__resident_") and fn.endswith("__.npz"):
+                    os.remove(os.path.join(self.data_path, fn))
+
+            arrays = dict(("output%d" % ii, output) for ii, output in enumerate(outputs))
+            with open(path + ".tmp", "wb") as f:
+                np.savez(f, indices=indices, inputs=inputs, **arrays)
+            os.rename(path + ".tmp", path)
+            log.info("Saved resident set %s" % path)
+
+        return indices, inputs, outputs
+
+    def generate(self, indices, batch_size, augment=False):
+        for ii in range(0, len(indices), batch_size):
+            next_indices = indices[ii:ii + batch_size]
+            yield self.get_batch(next_indices, augment=augment)
+
+    def prefetch_generate(self, indices, batch_size, queue_depth=4, num_threads=1, augment=False):
+        ' same as generate(), but batches are prepared in background threads '
+        return BatchPrefetcher(self, indices, batch_size, queue_depth, num_threads, augment)
+
+
+def create_from_train_config(transformer, conf, do_augment_data=False):
+    ' creates a DataCache, as configured by conf (a TrainNNConfig) '
+    return DataCache(transformer, conf.generation_prefix,
+                     do_augment_data=do_augment_data,
+                     sync_workers=conf.sync_workers,
+                     deep_verify=conf.deep_verify_data_cache,
+                     packed_states=conf.packed_states,
+                     sparse_policies=conf.sparse_policies,
+                     db_backend=conf.db_backend,
+                     lazy_augment=conf.lazy_augment_data,
+                     dedupe_states=conf.dedupe_data_cache,
+                     compact_inputs=conf.compact_inputs)
+
+
+class BatchPrefetcher(object):
+    ''' an iterator of batches (inputs, outputs) - the same as DataCache.generate().  The batches
+    are prepared by num_threads background threads (each with its own read only db handles), up to
+    queue_depth batches ahead of the consumer.  time_waiting is the time the consumer was blocked waiting on a batch. '''
+
+    def __init__(self, cache, indices, batch_size, queue_depth=4, num_threads=1, augment=False):
+        assert queue_depth > 0 and num_threads > 0
+        self.cache = cache
+        self.indices = indices
+        self.batch_size = batch_size
+        self.queue_depth = queue_depth
+        self.augment = augment
+
+        self.num_batches = (len(indices) + batch_size - 1) // batch_size
+
+        self.cond = threading.Condition()
+        self.results = {}
+        self.next_batch = 0
+        self.consumed = 0
+        self.stopped = False
+
+        self.time_waiting = 0.0
+        self.time_started = time.time()
+
+        self.threads = [threading.Thread(target=self.worker) for _ in range(num_threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    @property
+    def time_elapsed(self):
+        return time.time() - self.time_started
+
+    def worker(self):
+        # each thread reads through its own db handles
+        cache = self.cache.readonly_copy()
+        while True:
+            with self.cond:
+                while not self.stopped and self.next_batch - self.consumed >= self.queue_depth:
+                    self.cond.wait()
+
+                if self.stopped or self.next_batch >= self.num_batches:
+                    return
+
+                batch = self.next_batch
+                self.next_batch += 1
+
+            start = batch * self.batch_size
+            try:
+                result = True, cache.get_batch(self.indices[start:start + self.batch_size],
+                                               augment=self.augment)
+            except Exception:
+                result = False, traceback.format_exc()
+
+            with self.cond:
+                self.results[batch] = result
+                self.cond.notify_all()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.consumed >= self.num_batches:
+            raise StopIteration
+
+        with self.cond:
+            et = ElaspedTime()
+            while self.consumed not in self.results:
+                self.cond.wait()
+            self.time_waiting += et.update()
+
+            ok, result = self.results.pop(self.consumed)
+            self.consumed += 1
+            self.cond.notify_all()
+
+        if not ok:
+            self.stop()
+            raise Exception("Failed to prefetch batch:\n%s" % result)
+
+        return result
+
+    __next__ = next
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
@@ -6,7 +6,7 @@ from ggplib.util import log
 from ggpzero.util import attrutil
 from ggpzero.util.keras import keras_models
 
-from ggpzero.defs import confs, datadesc
+from ggpzero.defs import confs, datadesc, gamedesc
 
 from ggpzero.nn.network import NeuralNetwork
 from ggpzero.nn.model import get_network_model
@@ -21,7 +21,7 @@ def ensure_directory_exists(path):
 
 
 class Manager(object):
-    def __init__(self, data_path=None):
+    def __init__(self, data_path=None, cache_transformers=True):
 
         if data_path is None:
             data_path = os.path.join(os.environ["GGPZERO_PATH"], "data")
@@ -30,6 +30,9 @@ class Manager(object):
         # instantiated transformers, lazy constructed
         self.transformers = {}
 
+        # save/load the spaces of transformers to disk (see transformer_path())
+        self.cache_transformers = cache_transformers
+
     def samples_path(self, game, generation_prefix):
         p = os.path.join(self.data_path, game, generation_prefix)
         ensure_directory_exists(p)
@@ -59,8 +62,43 @@ class Manager(object):
             p = os.path.join(p, filename)
         return p
 
+    def transformer_path(self, game, key=None):
+        p = os.path.join(self.data_path, game, "transformers")
+        ensure_directory_exists(p)
+        if key is not None:
+            filename = "%s.json" % key
+            p = os.path.join(p, filename)
+        return p
+
+    def load_transformer_spaces(self, game, key):
+        ' returns the cached TransformerSpaces for key, or None if there are none (or are invalid) '
+        path = self.transformer_path(game, key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            spaces = attrutil.json_to_attr(open(path).read())
+            if isinstance(spaces, datadesc.TransformerSpaces) and spaces.key == key:
+                return spaces
+
+        except Exception as exc:
+            log.warning("Failed to load transformer spaces %s: %s" % (path, exc))
+            return None
+
+        log.warning("Ignoring mismatched transformer spaces %s" % path)
+        return None
+
+    def save_transformer_spaces(self, spaces):
+        path = self.transformer_path(spaces.game, spaces.key)
+
+        # other processes may be starting at the same time, write to a file of our own then rename
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "w") as f:
+            f.write(attrutil.attr_to_json(spaces))
+        os.rename(tmp_path, path)
+
     def get_transformer(self, game, generation_descr=None):
-        from ggpzero.nn.bases import GdlBasesTransformer, GdlBasesTransformer_Draws
+        from ggpzero.nn.bases import GdlBasesTransformer, GdlBasesTransformer_Draws, spaces_key
 
         if generation_descr is None:
             generation_descr = templates.default_generation_desc(game)
@@ -79,9 +117,22 @@ class Manager(object):
             log.debug("Looking up game: {}".format(game))
             game_info = lookup.by_name(game)
             transformer_clz = GdlBasesTransformer_Draws if generation_descr.draw_head else GdlBasesTransformer
-            transformer = transformer_clz(game_info, generation_descr)
-            self.transformers[key] = transformer
 
+            game_desc = getattr(gamedesc.Games(), game)()
+
+            if self.cache_transformers:
+                spaces_md5 = spaces_key(game_info, game_desc, generation_descr)
+                spaces = self.load_transformer_spaces(game, spaces_md5)
+                transformer = transformer_clz(game_info, generation_descr, game_desc, spaces=spaces)
+
+                if spaces is None:
+                    spaces = transformer.get_spaces()
+                    spaces.key = spaces_md5
+                    self.save_transformer_spaces(spaces)
+            else:
+                transformer = transformer_clz(game_info, generation_descr, game_desc)
+
+            self.transformers[key] = transformer
 
         log.debug("Created transformer: num_channels={}, num_cols={}, num_rows={}".format(transformer.num_channels, transformer.num_cols, transformer.num_rows))
 
@@ -4,6 +4,7 @@ import numpy as np
 
 from ggplib.util import log
 
+from ggpzero.util.state import decode_states
 from ggpzero.util.keras import SGD, Adam, keras_metrics, keras_regularizers, keras_models
 
 
@@ -38,14 +39,20 @@ class NeuralNetwork(object):
     def predict_n(self, states, prev_states=None):
         ' this is for testing purposes. We use C++ normally to access network '
         # prev_states -> list of list of states
+        t = self.gdl_bases_transformer
 
-        to_channels = self.gdl_bases_transformer.state_to_channels
+        states_matrix = decode_states(states)
+        prev_states_matrix = None
         if prev_states:
             assert len(prev_states) == len(states)
-            X = np.array([to_channels(s, prevs)
-                          for s, prevs in zip(states, prev_states)])
-        else:
-            X = np.array([to_channels(s) for s in states])
+            prev_states_matrix = np.zeros((len(states), t.num_previous_states, states_matrix.shape[1]),
+                                          dtype=np.uint8)
+            for ii, prevs in enumerate(prev_states):
+                if prevs:
+                    assert len(prevs) <= t.num_previous_states
+                    prev_states_matrix[ii, :len(prevs)] = decode_states(prevs)
+
+        X = t.states_to_channels(states_matrix, prev_states_matrix)
 
         Y = self.keras_model.predict(X, batch_size=len(states))
 
@@ -0,0 +1,264 @@
+''' storage backends for the DataCache db.
+
+A db is a table of named columns, each with a fixed dtype and row shape.  The tables returned by
+backends all support the subset of the bcolz ctable api DataCache uses:
+
+ * names, size
+ * table[name] -> column (with dtype, shape and numpy style indexing)
+ * table[int or list of ints] -> numpy record(s)
+ * append(cols), resize(n), flush()
+
+bcolz: a bcolz ctable (compressed, chunked)
+npy: a directory with an append only .npy file per column.  Reads are through np.memmap, so
+gathering a batch is just page cache reads (no decompression).
+'''
+
+import os
+import json
+import struct
+
+import numpy as np
+
+try:
+    import bcolz
+except ImportError:
+    bcolz = None
+
+
+class BcolzBackend(object):
+    name = "bcolz"
+
+    def __init__(self):
+        assert bcolz is not None, "bcolz is not installed"
+        bcolz.set_nthreads(4)
+
+    def create_table(self, rootdir, cols, names):
+        ' cols are example columns (of one row), for the dtypes/shapes.  Returns empty table. '
+        table = bcolz.ctable(cols, names=names, rootdir=rootdir)
+
+        # remove the single row
+        table.resize(0)
+        table.flush()
+        return table
+
+    def open_table(self, rootdir, readonly=False):
+        return bcolz.open(rootdir, mode='r' if readonly else 'a')
+
+    def is_table(self, rootdir):
+        ' whether rootdir looks like a table of this backend (ie a bcolz ctable) '
+        return os.path.exists(os.path.join(rootdir, "__rootdirs__"))
+
+    def chunk_len(self, table, name):
+        return table[name].chunklen
+
+
+###############################################################################
+
+# space reserved for the .npy header, so it can be rewritten in place as the column grows
+NPY_HEADER_SIZE = 256
+
+# memmaps have no chunks, but for locality (see block_shuffle()) treat this many bytes as one
+NPY_BLOCK_SIZE = 1024 * 1024
+
+
+def write_npy_header(f, dtype, shape):
+    ' writes a version 1.0 .npy header, padded to exactly NPY_HEADER_SIZE bytes '
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+        np.lib.format.dtype_to_descr(dtype), tuple(shape))
+
+    prefix = np.lib.format.magic(1, 0)
+    header_len = NPY_HEADER_SIZE - len(prefix) - 2
+    assert len(header) < header_len
+
+    f.seek(0)
+    f.write(prefix + struct.pack("<H", header_len) + header.ljust(header_len - 1) + "\n")
+
+
+class NpyColumn(object):
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, "rb") as f:
+            version = np.lib.format.read_magic(f)
+            assert version == (1, 0)
+            shape, fortran_order, self.dtype = np.lib.format.read_array_header_1_0(f)
+            assert not fortran_order
+            assert f.tell() == NPY_HEADER_SIZE
+
+        self.size = shape[0]
+        self.row_shape = shape[1:]
+        self.row_bytes = self.dtype.itemsize * int(np.prod(self.row_shape))
+
+        # created lazily, and discarded whenever the column changes size
+        self.mm = None
+
+    @classmethod
+    def create(cls, path, dtype, row_shape):
+        with open(path, "wb") as f:
+            write_npy_header(f, dtype, (0,) + tuple(row_shape))
+        return cls(path)
+
+    @property
+    def shape(self):
+        return (self.size,) + self.row_shape
+
+    def __len__(self):
+        return self.size
+
+    def array(self):
+        if self.size == 0:
+            return np.zeros(self.shape, dtype=self.dtype)
+
+        if self.mm is None:
+            self.mm = np.memmap(self.path, dtype=self.dtype, mode='r',
+                                offset=NPY_HEADER_SIZE, shape=self.shape)
+        return self.mm
+
+    def __getitem__(self, key):
+        return self.array()[key]
+
+    def append(self, values):
+        values = np.ascontiguousarray(values, dtype=self.dtype)
+        assert values.shape[1:] == self.row_shape
+
+        # anything past size (ie not flushed) is overwritten
+        with open(self.path, "r+b") as f:
+            f.seek(NPY_HEADER_SIZE + self.size * self.row_bytes)
+            f.write(values.tostring())
+
+        self.size += len(values)
+        self.mm = None
+
+    def resize(self, size):
+        assert size <= self.size, "can only shrink columns"
+        self.size = size
+        self.mm = None
+
+        with open(self.path, "r+b") as f:
+            f.truncate(NPY_HEADER_SIZE + self.size * self.row_bytes)
+        self.flush()
+
+    def flush(self):
+        ' the header is only updated on flush, so until then the column appears its old size '
+        with open(self.path, "r+b") as f:
+            write_npy_header(f, self.dtype, self.shape)
+
+
+class NpyTable(object):
+    META_FILENAME = "meta.json"
+
+    def __init__(self, rootdir, readonly=False):
+        self.rootdir = rootdir
+        self.readonly = readonly
+
+        with open(os.path.join(rootdir, self.META_FILENAME)) as f:
+            self.names = [str(name) for name in json.load(f)["names"]]
+
+        self.columns = [NpyColumn(self.column_path(name)) for name in self.names]
+
+        # a flush may have been interrupted part way through the columns.  A read only table (eg in
+        # a forked process) mustn't change the files under whoever has it open for writing.
+        sizes = [col.size for col in self.columns]
+        if len(set(sizes)) > 1:
+            if readonly:
+                raise Exception("Columns of %s have different sizes %s" % (rootdir, sizes))
+            self.resize(min(sizes))
+
+        self.dtype = np.dtype([(name, col.dtype, col.row_shape) if col.row_shape else (name, col.dtype)
+                               for name, col in zip(self.names, self.columns)])
+
+    @classmethod
+    def create(cls, rootdir, cols, names):
+        os.makedirs(rootdir)
+        for name, col in zip(names, cols):
+            NpyColumn.create(os.path.join(rootdir, "%s.npy" % name), col.dtype, col.shape[1:])
+
+        with open(os.path.join(rootdir, cls.META_FILENAME), "w") as f:
+            json.dump(dict(names=names), f)
+
+        return cls(rootdir)
+
+    def column_path(self, name):
+        return os.path.join(self.rootdir, "%s.npy" % name)
+
+    @property
+    def size(self):
+        return self.columns[0].size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return self.columns[self.names.index(key)]
+
+        # rows, as numpy records
+        if isinstance(key, slice):
+            key = np.arange(self.size)[key]
+
+        key = np.asarray(key)
+        record = np.empty(key.shape, dtype=self.dtype)
+        for name, col in zip(self.names, self.columns):
+            record[name] = col[key]
+
+        if not key.shape:
+            return record[()]
+        return record
+
+    def append(self, cols):
+        assert len(cols) == len(self.columns)
+        assert len(set(len(values) for values in cols)) == 1
+        for col, values in zip(self.columns, cols):
+            col.append(values)
+
+    def resize(self, size):
+        for col in self.columns:
+            col.resize(size)
+
+    def flush(self):
+        for col in self.columns:
+            col.flush()
+
+
+class NpyBackend(object):
+    name = "npy"
+
+    def create_table(self, rootdir, cols, names):
+        return NpyTable.create(rootdir, cols, names)
+
+    def open_table(self, rootdir, readonly=False):
+        # reads are always through read only memmaps
+        return NpyTable(rootdir, readonly=readonly)
+
+    def is_table(self, rootdir):
+        return os.path.exists(os.path.join(rootdir, NpyTable.META_FILENAME))
+
+    def chunk_len(self, table, name):
+        col = table[name]
+        return max(1, NPY_BLOCK_SIZE // max(1, col.row_bytes))
+
+
+BACKENDS = dict(bcolz=BcolzBackend, npy=NpyBackend)
+
+
+def copy_table(backend, table, rootdir, start, transform=None, chunk_rows=65536):
+    ''' creates a new table at rootdir, with rows [start:] of table.  transform is called with
+    each chunk of columns before it is appended (and may modify them in place). '''
+    cols = [np.zeros((1,) + table[name].shape[1:], dtype=table[name].dtype) for name in table.names]
+    new_table = backend.create_table(rootdir, cols, table.names)
+
+    for ii in range(start, table.size, chunk_rows):
+        # copies, since memmapped columns are read only
+        cols = [np.array(table[name][ii:ii + chunk_rows]) for name in table.names]
+        if transform is not None:
+            transform(cols)
+        new_table.append(cols)
+
+    new_table.flush()
+    return new_table
+
+
+def get_backend(name):
+    if name not in BACKENDS:
+        raise ValueError("Unknown db backend '%s', choose from %s" % (name, sorted(BACKENDS)))
+    return BACKENDS[name]()
@@ -1,12 +1,15 @@
 from builtins import super
 
+import os
 from datetime import datetime
 
+import numpy as np
+
 from ggplib.util import log
 from ggplib.db import lookup
 
 from ggpzero.util import attrutil
-from ggpzero.util.keras import keras_callbacks, Progbar
+from ggpzero.util.keras import keras_callbacks, KerasSequence, Progbar
 
 from ggpzero.defs import confs
 
@@ -190,6 +193,32 @@ class TrainingController(keras_callbacks.Callback):
             self.model.set_weights(self.best)
 
 
+class DataCacheSequence(KerasSequence):
+    ''' the batches of DataCache.generate(), indexable so keras can prepare them in parallel
+    (workers/use_multiprocessing).  Worker processes are forked, so the first batch in a new
+    process reopens the db and reseeds numpy (for lazy augmentation). '''
+
+    def __init__(self, cache, indices, batch_size, augment=False):
+        self.cache = cache
+        self.indices = indices
+        self.batch_size = batch_size
+        self.augment = augment
+        self.pid = os.getpid()
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, index):
+        if os.getpid() != self.pid:
+            self.pid = os.getpid()
+            self.cache.reopen_db()
+            np.random.seed()
+
+        start = index * self.batch_size
+        return self.cache.get_batch(self.indices[start:start + self.batch_size],
+                                    augment=self.augment)
+
+
 ###############################################################################
 
 class TrainManager(object):
@@ -306,27 +335,44 @@ class TrainManager(object):
 
         num_epochs = conf.epochs
 
-        cache = datacache.DataCache(self.transformer, conf.generation_prefix,
-                                    do_augment_data=self.do_data_augmentation)
+        cache = datacache.create_from_train_config(self.transformer, conf,
+                                                   do_augment_data=self.do_data_augmentation)
         cache.sync()
 
-        max_epoch_size = conf.max_epoch_size
-        if max_epoch_size is None:
-            max_epoch_size = cache.total_samples
-
         train_at_step = conf.next_step - 1
         ignore_after_step = conf.starting_step
         assert 0 <= ignore_after_step <= train_at_step
+
         buckets_def = datacache.Buckets(conf.resample_buckets)
+        if conf.compact_data_cache:
+            cache.compact(buckets_def, starting_step=train_at_step)
+
+        if conf.dedupe_data_cache:
+            cache.dedupe()
+
+        max_epoch_size = conf.max_epoch_size
+        if max_epoch_size is None:
+            max_epoch_size = cache.total_samples
 
         indexer = cache.create_chunk_indexer(buckets_def,
                                              starting_step=train_at_step,
                                              ignore_after_step=ignore_after_step,
-                                             validation_split=conf.validation_split)
+                                             validation_split=conf.validation_split,
+                                             window_chunks=conf.shuffle_window_chunks)
 
         # first get validation data, then we can forget about it as it doesn't need reshuffled
         validation_size = int(max_epoch_size * (1 - conf.validation_split))
-        validation_indices = indexer.validation_epoch(validation_size)
+        if conf.resident_validation:
+            # gather it once into memory, and validate against that every epoch
+            cache_key = None
+            if conf.cache_validation_set:
+                cache_key = (conf.resample_buckets, train_at_step, ignore_after_step,
+                             conf.validation_split, validation_size)
+
+            validation_indices, validation_inputs, validation_outputs = cache.resident_set(
+                lambda: indexer.validation_epoch(validation_size), cache_key=cache_key)
+        else:
+            validation_indices = indexer.validation_epoch(validation_size)
 
         training_logger = TrainingLoggerCb(conf.epochs, conf.batch_size)
         self.controller = TrainingController(len(self.transformer.policy_dist_count))
@@ -353,17 +399,62 @@ class TrainManager(object):
             assert len(validation_indices) / conf.batch_size > 0, \
                 "validation steps must be more than zero (not enough data)"
 
+            prefetching = conf.sequence_workers <= 0 and conf.prefetch_batches > 0
+            use_multiprocessing = False
+            if conf.sequence_workers > 0:
+                def gen(indices, augment):
+                    return DataCacheSequence(cache, indices, conf.batch_size, augment=augment)
+
+                # keras prepares the batches in parallel
+                workers = conf.sequence_workers
+                use_multiprocessing = conf.sequence_multiprocessing
+
+            elif prefetching:
+                def gen(indices, augment):
+                    return cache.prefetch_generate(indices, conf.batch_size,
+                                                   queue_depth=conf.prefetch_batches,
+                                                   num_threads=conf.prefetch_threads,
+                                                   augment=augment)
+
+                # already threaded, keras doesn't need to wrap them in its own thread
+                workers = 0
+            else:
+                def gen(indices, augment):
+                    return cache.generate(indices, conf.batch_size, augment=augment)
+                workers = 1
+
+            # only training data is augmented (if lazy_augment_data)
+            training_gen = gen(training_indices, True)
+            if conf.resident_validation:
+                validation_gen = validation_inputs, validation_outputs
+            else:
+                validation_gen = gen(validation_indices, False)
+
             fitter = self.nn.get_model().fit_generator
-            fitter(cache.generate(training_indices, conf.batch_size),
+            fitter(training_gen,
                    len(training_indices) / conf.batch_size,
                    epochs=1,
                    verbose=0,
-                   validation_data=cache.generate(validation_indices, conf.batch_size),
+                   validation_data=validation_gen,
                    validation_steps=len(validation_indices) / conf.batch_size,
                    callbacks=[training_logger, self.controller],
                    shuffle=False,
+                   workers=workers,
+                   use_multiprocessing=use_multiprocessing,
                    initial_epoch=0)
 
+            if prefetching:
+                gens = [("training", training_gen)]
+                if not conf.resident_validation:
+                    gens.append(("validation", validation_gen))
+
+                for name, g in gens:
+                    # any left over batches (keras drops the last partial batch)
+                    g.stop()
+                    log.info("%s: waited on batches %.1fs of %.1fs" % (name,
+                                                                       g.time_waiting,
+                                                                       g.time_elapsed))
+
             self.do_callbacks()
 
         self.controller.do_train_end()
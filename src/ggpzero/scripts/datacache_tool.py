@@ -0,0 +1,158 @@
+''' maintenance of the training data cache (gendata files, summary and db).
+
+usage:
+  python datacache_tool.py verify <game> <gen_prefix> [--deep-verify]
+  python datacache_tool.py compact <server_config_file>
+  python datacache_tool.py dedupe <server_config_file>
+  python datacache_tool.py metrics <game> <gen_prefix> [--last N]
+  python datacache_tool.py convert <game> <gen_prefix> [--remove]
+
+verify: checks the summary against the gendata files.  md5sums are taken from the fingerprints
+file, unless a file is new/changed or --deep-verify is given (which rehashes every file).
+
+compact: drops steps from the data cache db of a server config, that are outside the window of its
+training config's resample_buckets.  Does not sync (new files are added on the next training).
+
+dedupe: merges the samples with the same state in the data cache db of a server config (its
+training config must have packed_states and dedupe_data_cache).
+
+metrics: shows the time/samples/bytes of each stage of ingest, for the last N (default 10) files
+ingested.
+
+convert: converts the json gendata files to the binary format (see util/gendata.py).  The data cache
+uses the binary file of a step, if there is one.  With --remove, the json files are deleted.
+'''
+
+import os
+import sys
+
+from ggplib.util import log
+
+from ggpzero.util import attrutil, gendata, metrics as metrics_util
+from ggpzero.defs import confs
+from ggpzero.nn import datacache
+from ggpzero.nn.manager import get_manager
+
+
+def usage():
+    print __doc__
+    sys.exit(1)
+
+
+def get_cache(game, gen_prefix, **kwds):
+    transformer = get_manager().get_transformer(game)
+    return datacache.DataCache(transformer, gen_prefix, **kwds)
+
+
+def verify(args):
+    deep_verify = "--deep-verify" in args
+    args = [a for a in args if a != "--deep-verify"]
+    if len(args) != 2:
+        usage()
+
+    game, gen_prefix = args
+    cache = get_cache(game, gen_prefix, deep_verify=deep_verify)
+
+    if cache.check_summary():
+        log.info("Summary ok: %s samples in %d steps" % (cache.summary.total_samples,
+                                                         len(cache.summary.step_summaries)))
+    else:
+        log.error("Summary check failed, cache will be rebuilt on next sync")
+        sys.exit(1)
+
+
+def get_server_cache(args):
+    ' returns the training config and data cache, of the server config file in args '
+    if len(args) != 1 or not os.path.exists(args[0]):
+        usage()
+
+    conf = attrutil.json_to_attr(open(args[0]).read())
+    assert isinstance(conf, confs.ServerConfig)
+
+    train_config = conf.base_training_config
+    transformer = get_manager().get_transformer(conf.game, conf.base_generation_description)
+    return train_config, datacache.create_from_train_config(transformer, train_config)
+
+
+def compact(args):
+    train_config, cache = get_server_cache(args)
+
+    num_dropped = cache.compact(datacache.Buckets(train_config.resample_buckets))
+    log.info("Dropped %d steps, db now has %d samples" % (num_dropped, cache.total_samples))
+
+
+def dedupe(args):
+    train_config, cache = get_server_cache(args)
+    if not train_config.dedupe_data_cache:
+        log.error("Training config does not have dedupe_data_cache set")
+        sys.exit(1)
+
+    num_removed = cache.dedupe()
+    log.info("Removed %d samples, db now has %d samples" % (num_removed, cache.total_samples))
+
+
+def metrics(args):
+    last = 10
+    if "--last" in args:
+        indx = args.index("--last")
+        if indx + 1 >= len(args):
+            usage()
+        last = int(args[indx + 1])
+        args = args[:indx] + args[indx + 2:]
+
+    if len(args) != 2:
+        usage()
+
+    game, gen_prefix = args
+    cache = get_cache(game, gen_prefix)
+
+    history = cache.get_ingest_metrics()
+    if not history.ingests:
+        log.warning("No metrics in %s" % cache.metrics_path)
+        return
+
+    for m in history.ingests[-last:]:
+        log.info("step %d: %s (%s)" % (m.step, os.path.basename(m.filename), m.date_created))
+        log.info("%d samples in %.2fs (%.1f samples/s) config: %s" % (
+            m.num_samples, m.wall_seconds, metrics_util.rate(m.num_samples, m.wall_seconds),
+            ", ".join("%s=%s" % kv for kv in sorted(m.config.items()))))
+        for s in m.stages:
+            log.info("  " + metrics_util.format_stage(s))
+
+
+def convert(args):
+    remove = "--remove" in args
+    args = [a for a in args if a != "--remove"]
+    if len(args) != 2:
+        usage()
+
+    game, gen_prefix = args
+    data_path = get_manager().samples_path(game, gen_prefix)
+
+    match_start_with = "gendata_%s_" % game
+    for fn in sorted(os.listdir(data_path)):
+        if not (fn.startswith(match_start_with) and fn.endswith(gendata.JSON_EXT)):
+            continue
+
+        json_path = os.path.join(data_path, fn)
+        binary_path = gendata.convert_to_binary(json_path)
+        log.info("Converted %s -> %s (%.1fMB -> %.1fMB)" % (fn, os.path.basename(binary_path),
+                                                          os.path.getsize(json_path) / 1e6,
+                                                          os.path.getsize(binary_path) / 1e6))
+        if remove:
+            os.remove(json_path)
+
+
+COMMANDS = dict(verify=verify, compact=compact, dedupe=dedupe, metrics=metrics,
+                convert=convert)
+
+
+if __name__ == "__main__":
+    def main(args):
+        if not args or args[0] not in COMMANDS:
+            usage()
+
+        COMMANDS[args[0]](args[1:])
+
+    from ggpzero.util.main import main_wrap
+    main_wrap(main)
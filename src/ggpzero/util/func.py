@@ -9,6 +9,19 @@ def chunks(l, n):
         yield l[i:i + n]
 
 
+def ichunks(iterable, n):
+    ' like chunks(), but works with any iterable (including generators) '
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == n:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
 def get_from_json(path, includes=None, excludes=None):
     includes = includes or []
     excludes = excludes or []
@@ -0,0 +1,374 @@
+''' reading/writing gendata_<game>_<step> files (as written by ServerBroker.save_sample_data()).
+
+json (gendata_<game>_<step>.json.gz)
+------------------------------------
+The files are one big json document (a datadesc.GenerationSamples).  Decoding it all in one go
+(json_to_attr) needs the entire decompressed string and every Sample object in memory at the same
+time.  GenDataReader instead decodes the samples list one sample at a time, so memory is bounded by
+however many samples the caller holds onto.
+
+binary (gendata_<game>_<step>.npz)
+----------------------------------
+A numpy .npz archive, with a column (.npy) per field of the samples:
+
+ * version, header - the format version and the GenerationSamples (without samples) as json
+ * state (n x packed bytes), prev_states (n x max prev states x packed bytes) and prev_states_count
+   - basestates as packed bits (as pack_state())
+ * policy<ri>_count, policy<ri>_legal, policy<ri>_prob - the policies of each role in CSR form
+   (counts per sample, and the concatenated (legal, prob) pairs)
+ * final_score, resultant_puct_score - float arrays (n x roles)
+ * depth, game_length, ... - the remaining per sample metadata
+
+Reading/writing is numpy, no json encoding/decoding or base64 of the samples.  GenDataBinaryReader
+has the same interface as GenDataReader (and yields the same Samples).  get_reader() returns the
+right reader for a path, and convert_to_binary() converts a json file.
+
+columns
+-------
+Both readers also have iter_column_chunks(), yielding chunks of samples as the columns of the
+binary format (a dict of name -> array, without version/header).  For the binary format these are
+slices of the file's arrays, so no Samples are created (this is how the data cache ingests).  For
+json, each chunk of Samples is converted with sample_columns().
+'''
+
+import os
+import re
+import gzip
+import json
+import base64
+
+import numpy as np
+
+from ggplib.util import log
+
+from ggpzero.util import attrutil, func
+from ggpzero.defs import datadesc
+
+
+# size of decompressed data to read at a time
+READ_SIZE = 1024 * 1024
+
+SAMPLES_KEY_RE = re.compile(r'"samples"\s*:\s*\[')
+NUM_SAMPLES_RE = re.compile(r'"num_samples"\s*:\s*(\d+)')
+
+WHITESPACE = ' \t\r\n'
+
+JSON_EXT = ".json.gz"
+BINARY_EXT = ".npz"
+
+# bump whenever the columns of the binary format change
+BINARY_VERSION = 1
+
+# the per sample metadata columns of the binary format, and their dtypes
+METADATA_COLUMNS = [("depth", np.int32),
+                    ("game_length", np.int32),
+                    ("match_identifier", None),
+                    ("has_resigned", np.bool_),
+                    ("resign_false_positive", np.bool_),
+                    ("starting_sample_depth", np.int32),
+                    ("resultant_puct_visits", np.int32)]
+
+
+class GenDataException(Exception):
+    pass
+
+
+class GenDataReader(object):
+    ''' iterate over a gendata file to get the samples.  Once all the samples have been iterated
+    over, header is set (a GenerationSamples with an empty samples list). '''
+
+    def __init__(self, path, read_size=READ_SIZE):
+        self.path = path
+        self.read_size = read_size
+
+        # set once fully read
+        self.header = None
+
+    def __iter__(self):
+        return self.iter_samples()
+
+    def iter_chunks(self, chunk_size):
+        ' yields lists of up to chunk_size samples '
+        return func.ichunks(self.iter_samples(), chunk_size)
+
+    def iter_column_chunks(self, chunk_size):
+        ' yields up to chunk_size samples at a time, as columns (see sample_columns()) '
+        for chunk in self.iter_chunks(chunk_size):
+            yield sample_columns(chunk)
+
+    def iter_samples(self):
+        decoder = json.JSONDecoder()
+
+        with gzip.open(self.path) as f:
+            buf = f.read(self.read_size)
+
+            # find start of samples list.  Everything before it is part of the header.
+            while True:
+                match = SAMPLES_KEY_RE.search(buf)
+                if match is not None:
+                    break
+
+                more = f.read(self.read_size)
+                if not more:
+                    raise GenDataException("No samples found in %s" % self.path)
+                buf += more
+
+            prefix = buf[:match.start()]
+            pos = match.end()
+
+            # the header may or may not be before the samples (depends on dict ordering).  If it
+            # is, can trim samples as we go.
+            num_samples = None
+            match = NUM_SAMPLES_RE.search(prefix)
+            if match is not None:
+                num_samples = int(match.group(1))
+
+            count = 0
+            eof = False
+            while True:
+                while pos < len(buf) and (buf[pos] in WHITESPACE or buf[pos] == ','):
+                    pos += 1
+
+                d = None
+                if pos < len(buf):
+                    if buf[pos] == ']':
+                        pos += 1
+                        break
+
+                    try:
+                        d, pos = decoder.raw_decode(buf, pos)
+                    except ValueError:
+                        pass
+
+                if d is None:
+                    # a partial sample - read some more
+                    if eof:
+                        raise GenDataException("Failed to decode sample %d in %s" % (count, self.path))
+
+                    more = f.read(self.read_size)
+                    eof = not more
+                    buf = buf[pos:] + more
+                    pos = 0
+                    continue
+
+                count += 1
+                if num_samples is not None and count > num_samples:
+                    continue
+
+                yield datadesc.Sample(**d)
+
+            # the remainder of the header
+            suffix = buf[pos:] + f.read()
+
+        header_json = prefix + '"samples": []' + suffix
+        self.header = attrutil.json_to_attr(header_json)
+        assert isinstance(self.header, datadesc.GenerationSamples)
+
+        if count != self.header.num_samples:
+            # pretty inconsequential, but we should at least notify
+            msg = "num_samples (%d) versus actual samples (%s) differ"
+            if num_samples is not None:
+                msg += "... trimming"
+            log.warning(msg % (self.header.num_samples, count))
+
+        if num_samples is None:
+            self.header.num_samples = count
+        else:
+            self.header.num_samples = min(count, num_samples)
+
+
+class GenDataBinaryReader(object):
+    ''' iterate over a binary gendata file to get the samples.  header is set once the columns
+    are read (ie on starting to iterate). '''
+
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+
+    def __iter__(self):
+        return self.iter_samples()
+
+    def iter_chunks(self, chunk_size):
+        ' yields lists of up to chunk_size samples '
+        return func.ichunks(self.iter_samples(), chunk_size)
+
+    def read_columns(self):
+        ' returns dict of name -> numpy array, of all the columns in the file '
+        with open(self.path, "rb") as f:
+            archive = np.load(f)
+            try:
+                version = int(archive["version"])
+                if version > BINARY_VERSION:
+                    raise GenDataException("%s is version %d, only up to %d supported" % (
+                        self.path, version, BINARY_VERSION))
+
+                cols = dict((name, archive[name]) for name in archive.files)
+            finally:
+                archive.close()
+
+        self.header = attrutil.json_to_attr(cols.pop("header").item())
+        assert isinstance(self.header, datadesc.GenerationSamples)
+        cols.pop("version")
+        return cols
+
+    def iter_column_chunks(self, chunk_size):
+        ' yields up to chunk_size samples at a time, as slices of the columns of the file '
+        cols = self.read_columns()
+        num_samples = self.header.num_samples
+        role_count = len([name for name in cols if name.endswith("_legal")])
+
+        # where each sample's policy starts in the (legal, prob) pairs, for each role
+        policy_starts = [np.concatenate([[0], np.cumsum(cols["policy%d_count" % ri])])
+                         for ri in range(role_count)]
+
+        for start in range(0, num_samples, chunk_size):
+            end = min(start + chunk_size, num_samples)
+
+            chunk = {}
+            for name, values in cols.items():
+                if name.endswith("_legal") or name.endswith("_prob"):
+                    continue
+                chunk[name] = values[start:end]
+
+            for ri, starts in enumerate(policy_starts):
+                for name in ("policy%d_legal" % ri, "policy%d_prob" % ri):
+                    chunk[name] = cols[name][starts[start]:starts[end]]
+
+            yield chunk
+
+    def iter_samples(self):
+        cols = self.read_columns()
+        num_samples = self.header.num_samples
+        role_count = len([name for name in cols if name.endswith("_legal")])
+
+        encode = base64.encodestring
+        states = [encode(s.tostring()) for s in cols["state"]]
+        prev_states_count = cols["prev_states_count"]
+
+        policies = []
+        for ri in range(role_count):
+            counts = cols["policy%d_count" % ri]
+            pairs = zip(cols["policy%d_legal" % ri].tolist(), cols["policy%d_prob" % ri].tolist())
+            ends = np.cumsum(counts).tolist()
+            policies.append([pairs[end - count:end] for end, count in zip(ends, counts.tolist())])
+
+        final_scores = cols["final_score"].tolist()
+        puct_scores = cols["resultant_puct_score"].tolist()
+        metadata = [cols[name].tolist() for name, _ in METADATA_COLUMNS]
+
+        for ii in range(num_samples):
+            prev_states = [encode(s.tostring())
+                           for s in cols["prev_states"][ii, :prev_states_count[ii]]]
+
+            kwds = dict((name, values[ii]) for (name, _), values in zip(METADATA_COLUMNS, metadata))
+            yield datadesc.Sample(state=states[ii],
+                                  prev_states=prev_states,
+                                  policies=[p[ii] for p in policies],
+                                  final_score=final_scores[ii],
+                                  resultant_puct_score=puct_scores[ii],
+                                  **kwds)
+
+
+def float_rows(rows):
+    ' list of lists of floats (all the same length) as a float32 matrix, even when there are none '
+    if not rows:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.array(rows, dtype=np.float32)
+
+
+def sample_columns(samples):
+    ' the columns of the binary format (without version/header) for a list of Samples '
+    num_samples = len(samples)
+
+    cols = {}
+    # imported here, as state needs the c++ interface (and only converting Samples needs it)
+    from ggpzero.util.state import pack_states
+
+    cols["state"] = pack_states([s.state for s in samples])
+
+    max_prev_states = max([len(s.prev_states) for s in samples] + [0])
+    prev_states = np.zeros((num_samples, max_prev_states, cols["state"].shape[1]), dtype=np.uint8)
+    for ii, s in enumerate(samples):
+        if s.prev_states:
+            prev_states[ii, :len(s.prev_states)] = pack_states(s.prev_states)
+    cols["prev_states"] = prev_states
+    cols["prev_states_count"] = np.array([len(s.prev_states) for s in samples], dtype=np.int32)
+
+    role_count = len(samples[0].policies) if samples else 0
+    for ri in range(role_count):
+        policies = [s.policies[ri] for s in samples]
+        cols["policy%d_count" % ri] = np.array([len(p) for p in policies], dtype=np.int32)
+        cols["policy%d_legal" % ri] = np.array([legal for p in policies for legal, _ in p],
+                                               dtype=np.int32)
+        cols["policy%d_prob" % ri] = np.array([prob for p in policies for _, prob in p],
+                                              dtype=np.float32)
+
+    cols["final_score"] = float_rows([s.final_score for s in samples])
+    cols["resultant_puct_score"] = float_rows([s.resultant_puct_score for s in samples])
+
+    for name, dtype in METADATA_COLUMNS:
+        cols[name] = np.array([getattr(s, name) for s in samples], dtype=dtype)
+
+    return cols
+
+
+def write_binary(path, header, samples):
+    ''' writes a binary gendata file.  header is a GenerationSamples (its samples are ignored), and
+    num_samples is set to the number of samples written.  The file is written to a temporary file
+    and renamed, so readers never see a partial file. '''
+    samples = list(samples)
+    cols = sample_columns(samples)
+
+    header = datadesc.GenerationSamples(game=header.game,
+                                        date_created=header.date_created,
+                                        with_generation=header.with_generation,
+                                        num_samples=len(samples))
+
+    cols["version"] = np.array(BINARY_VERSION)
+    cols["header"] = np.array(attrutil.attr_to_json(header, pretty=False))
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **cols)
+    os.rename(tmp_path, path)
+
+    return header
+
+
+def get_reader(path):
+    ' the reader for a gendata file (by extension) '
+    if path.endswith(BINARY_EXT):
+        return GenDataBinaryReader(path)
+    return GenDataReader(path)
+
+
+def read_header(path):
+    ''' the header (a GenerationSamples, without samples) of a gendata file.  Only the header is
+    read from a binary file, a json file has to be read through. '''
+    if path.endswith(BINARY_EXT):
+        with open(path, "rb") as f:
+            archive = np.load(f)
+            try:
+                header = attrutil.json_to_attr(archive["header"].item())
+            finally:
+                archive.close()
+
+        assert isinstance(header, datadesc.GenerationSamples)
+        return header
+
+    reader = GenDataReader(path)
+    for _ in reader:
+        pass
+    return reader.header
+
+
+def convert_to_binary(json_path, binary_path=None):
+    ' converts a json gendata file to binary.  Returns the path of the binary file. '
+    assert json_path.endswith(JSON_EXT)
+    if binary_path is None:
+        binary_path = json_path[:-len(JSON_EXT)] + BINARY_EXT
+
+    reader = GenDataReader(json_path)
+    samples = list(reader)
+    write_binary(binary_path, reader.header, samples)
+    return binary_path
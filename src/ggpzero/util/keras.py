@@ -4,6 +4,7 @@ from ggplib.util import log
 
 from keras.optimizers import SGD, Adam
 from keras.utils.generic_utils import Progbar
+from keras.utils import Sequence as KerasSequence
 import keras.callbacks as keras_callbacks
 from keras import metrics as keras_metrics
 import keras.backend as K
@@ -16,7 +17,7 @@ import multiprocessing
 
 def _bla():
     ' i am here to confuse flake8 '
-    print SGD, Adam, Progbar, keras_callbacks, keras_metrics
+    print SGD, Adam, Progbar, KerasSequence, keras_callbacks, keras_metrics
     print keras_models, keras_layers, keras_regularizers
 
 
@@ -0,0 +1,71 @@
+''' metrics for named stages of a pipeline (time spent, samples processed and bytes read/written).
+The stages are datadesc.StageMetrics, so they can be saved as json and compared across runs. '''
+
+import time
+
+from ggpzero.defs import datadesc
+
+
+class Metrics(object):
+    def __init__(self):
+        # in order of first use
+        self.stages = []
+        self.by_name = {}
+
+        self.time_started = time.time()
+
+    def stage(self, name):
+        ' returns the StageMetrics for name (created on first use) '
+        stage = self.by_name.get(name)
+        if stage is None:
+            stage = self.by_name[name] = datadesc.StageMetrics(name)
+            self.stages.append(stage)
+        return stage
+
+    def add(self, name, seconds=0.0, samples=0, bytes_read=0, bytes_written=0):
+        stage = self.stage(name)
+        stage.seconds += seconds
+        stage.samples += samples
+        stage.bytes_read += bytes_read
+        stage.bytes_written += bytes_written
+
+    def merge(self, other):
+        ' adds all the stages of other Metrics to this '
+        for s in other.stages:
+            self.add(s.name, s.seconds, s.samples, s.bytes_read, s.bytes_written)
+
+    def timer(self):
+        return StageTimer(self)
+
+    @property
+    def wall_seconds(self):
+        return time.time() - self.time_started
+
+    def report(self):
+        ' one line per stage, for logging '
+        return [format_stage(s) for s in self.stages]
+
+
+class StageTimer(object):
+    ''' times consecutive stages.  Each call to lap(name) adds the time since the previous lap (or
+    creation) to stage name. '''
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.at_time = time.time()
+
+    def lap(self, name):
+        cur_time = time.time()
+        self.metrics.add(name, seconds=cur_time - self.at_time)
+        self.at_time = cur_time
+
+
+def rate(count, seconds):
+    return count / seconds if seconds > 0 else 0.0
+
+
+def format_stage(s):
+    MB = 1024.0 * 1024.0
+    return "%-10s %8.2fs %8d samples %10.1f samples/s %8.1fMB read %8.1fMB written" % (
+        s.name, s.seconds, s.samples, rate(s.samples, s.seconds),
+        s.bytes_read / MB, s.bytes_written / MB)
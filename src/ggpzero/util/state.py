@@ -35,3 +35,35 @@ def fast_decode_state(s):
         return tuple(s)
 
     return ggpzero_interface.buf_to_tuple_reverse_bytes(base64.decodestring(s))
+
+
+def pack_state(s):
+    ' returns the state as packed bits (numpy uint8 array), from either an encoded or decoded state '
+    if isinstance(s, (tuple, list)):
+        return np.packbits(np.array(s, dtype=np.uint8))
+
+    return np.fromstring(base64.decodestring(s), dtype=np.uint8)
+
+
+def pack_states(states):
+    ''' returns the packed bits of a list of states (encoded or decoded, as pack_state()), as one
+    uint8 matrix (num states x packed bytes) '''
+    if not len(states):
+        return np.zeros((0, 0), dtype=np.uint8)
+
+    if all(isinstance(s, basestring) for s in states):
+        # decode all the strings into one buffer
+        buf = "".join(base64.decodestring(s) for s in states)
+        return np.fromstring(buf, dtype=np.uint8).reshape(len(states), -1)
+
+    return np.array([pack_state(s) for s in states], dtype=np.uint8)
+
+
+def decode_states(states, num_bases=None):
+    ''' batch version of decode_state(), returns a uint8 bit matrix (num states x num_bases) with a
+    single np.unpackbits().  Without num_bases, rows are padded to a multiple of 8 (as
+    decode_state()). '''
+    bits = np.unpackbits(pack_states(states), axis=1)
+    if num_bases is not None:
+        bits = bits[:, :num_bases]
+    return bits
@@ -1,3 +1,5 @@
+import numpy as np
+
 from ggplib.util.symbols import SymbolFactory, ListTerm, Term
 
 
@@ -72,6 +74,10 @@ class Translator(object):
         # set first time in translate_basestate_faster
         self.base_translate_symbols_indices = None
 
+        # compiled translations (see base_permutation() / action_mapping())
+        self.base_permutations = {}
+        self.action_mappings = {}
+
     def add_basetype(self, root_term, x_terms_idx, y_terms_idx):
         assert root_term not in self.base_root_term_indexes
 
@@ -143,13 +149,85 @@ class Translator(object):
         self.translate_basestate_cache[key] = new_bs_indx
         return new_bs_indx
 
-    def translate_basestate_faster(self, basestate, do_reflection, rot_count):
-        # all skips copied... phew
-        new_basestate = list(basestate)
+    def base_permutation(self, do_reflection, rot_count):
+        ''' returns an index array perm, such that basestate[perm] is the translated basestate.
+        Works on the last axis, so can translate a whole batch of basestates in one go. '''
+        key = do_reflection, rot_count
+        perm = self.base_permutations.get(key)
+        if perm is not None:
+            return perm
 
-        if not do_reflection and rot_count == 0:
-            return new_basestate
+        # skipped bases stay where they are
+        perm = np.arange(len(self.base_symbols))
+
+        if do_reflection or rot_count:
+            self.init_base_translate_symbols_indices()
+
+            sources = self.base_translate_symbols_indices
+            targets = [self.translate_basestate_helper(self.base_symbols[indx], do_reflection, rot_count)
+                       for indx in sources]
+
+            assert len(set(targets)) == len(targets), "translation of bases is not a permutation"
+            perm[targets] = sources
+
+        self.base_permutations[key] = perm
+        return perm
+
+    def action_mapping(self, role_index, do_reflection, rot_count):
+        ''' returns an index array, mapping legal -> translated legal for role_index.  Actions that
+        can not be translated are -1 (only an error if a policy uses them, see translate_legals()). '''
+        key = role_index, do_reflection, rot_count
+        mapping = self.action_mappings.get(key)
+        if mapping is not None:
+            return mapping
+
+        action_list = self.action_list[role_index]
+        mapping = np.arange(len(action_list))
+
+        if do_reflection or rot_count:
+            legal_lookup = {tuple(terms): legal for legal, terms in enumerate(action_list)}
+
+            for legal, terms in enumerate(action_list):
+                root_term = terms[0]
+                if root_term in self.skip_action_root_term:
+                    continue
 
+                if root_term not in self.action_root_term_indexes:
+                    mapping[legal] = -1
+                    continue
+
+                x_terms_idx, y_terms_idx = self.action_root_term_indexes[root_term]
+                new_terms = self.translate_terms(terms, x_terms_idx, y_terms_idx,
+                                                 do_reflection, rot_count)
+                mapping[legal] = legal_lookup.get(tuple(new_terms), -1)
+
+        self.action_mappings[key] = mapping
+        return mapping
+
+    def translate_basestates(self, basestates, do_reflection, rot_count):
+        ' basestates is a numpy array, with bases on the last axis (ie one basestate or a batch) '
+        return basestates[..., self.base_permutation(do_reflection, rot_count)]
+
+    def translate_legals(self, role_index, legals, do_reflection, rot_count):
+        ' legals is a numpy array of legals (for role_index) '
+        new_legals = self.action_mapping(role_index, do_reflection, rot_count)[legals]
+        assert (new_legals >= 0).all(), "Did not find translation"
+        return new_legals
+
+    def translate_policies(self, role_index, policies, do_reflection, rot_count):
+        ' policies is a numpy array, with the policy distribution on the last axis '
+        mapping = self.action_mapping(role_index, do_reflection, rot_count)
+
+        # actions that can't be translated must have no probability
+        valid = mapping >= 0
+        if not valid.all():
+            assert not policies[..., ~valid].any(), "Did not find translation"
+
+        new_policies = np.zeros_like(policies)
+        new_policies[..., mapping[valid]] = policies[..., valid]
+        return new_policies
+
+    def init_base_translate_symbols_indices(self):
         if self.base_translate_symbols_indices is None:
             self.base_translate_symbols_indices = []
             for indx, terms in enumerate(self.base_symbols):
@@ -161,18 +239,13 @@ class Translator(object):
 
                 self.base_translate_symbols_indices.append(indx)
 
-        set_these = []
-        for indx in self.base_translate_symbols_indices:
-            if new_basestate[indx]:
-                terms = self.base_symbols[indx]
-                new_bs_indx = self.translate_basestate_helper(terms, do_reflection, rot_count)
-                set_these.append(new_bs_indx)
-                new_basestate[indx] = 0
-
-        for indx in set_these:
-            new_basestate[indx] = 1
+    def translate_basestate_faster(self, basestate, do_reflection, rot_count):
+        # all skips copied... phew
+        if not do_reflection and rot_count == 0:
+            return list(basestate)
 
-        return new_basestate
+        perm = self.base_permutation(do_reflection, rot_count)
+        return np.asarray(basestate)[perm].tolist()
 
     def translate_basestate(self, basestate, do_reflection, rot_count):
         # takes tuple/list, return new list (including self)
@@ -1,16 +1,23 @@
+# std imports
+import os
+import random
+import shutil
+
+import numpy as np
 
 # ggplib imports
 from ggplib.util import log
 
 # ggpzero imports
 from ggplib.db import lookup
-from ggpzero.nn import datacache
-from ggpzero.defs import templates
+from ggpzero.nn import datacache, storage
+from ggpzero.util import gendata
+from ggpzero.defs import datadesc, templates
 
 from ggpzero.nn.manager import get_manager
 
 
-def setup_and_get_cache(game, prev_states, gen):
+def setup_and_get_cache(game, prev_states, gen, **kwds):
     # cp some files to a test area
 
     lookup.get_database()
@@ -20,7 +27,7 @@ def setup_and_get_cache(game, prev_states, gen):
                                                          num_previous_states=prev_states)
     man = get_manager()
     transformer = man.get_transformer(game, generation_descr)
-    return datacache.DataCache(transformer, gen)
+    return datacache.DataCache(transformer, gen, **kwds)
 
 
 def test_summary():
@@ -48,6 +55,67 @@ def test_summary():
             log.info('train output, shape: %s.  Example: %s' % (output.shape, output))
 
 
+STATS_ATTRS = ("num_samples unique_matches draw_ratio bare_policies_ratio av_starting_depth "
+               "av_ending_depth av_resigns av_resign_false_positive av_puct_visits "
+               "ratio_of_roles av_final_scores av_puct_score_dist").split()
+
+
+def fake_match_samples(num_matches):
+    samples = []
+    for match_indx in range(num_matches):
+        start_depth = random.randint(0, 5)
+        final_score = random.choice([[1.0, 0.0], [0.0, 1.0], [0.5, 0.5]])
+        for depth in range(start_depth, start_depth + random.randint(1, 12)):
+            policies = [[(legal, 1.0) for legal in range(random.choice([1, 1, 3]))] for _ in range(2)]
+            samples.append(datadesc.Sample(match_identifier="m%d" % match_indx,
+                                           depth=depth,
+                                           policies=policies,
+                                           final_score=final_score,
+                                           has_resigned=random.random() < 0.2,
+                                           resign_false_positive=random.random() < 0.1,
+                                           resultant_puct_visits=random.randint(1, 800),
+                                           resultant_puct_score=[random.random(), 0.0]))
+    return samples
+
+
+def test_stats_accumulator():
+    samples = fake_match_samples(40)
+    was_draws = [s.final_score[0] == 0.5 for s in samples]
+
+    # one at a time
+    expect = datacache.StatsAccumulator()
+    for sample, was_draw in zip(samples, was_draws):
+        expect.add(sample, was_draw)
+
+    # in chunks, that split matches across chunk boundaries
+    for chunk_size in (1, 7, 64, len(samples)):
+        stats = datacache.StatsAccumulator()
+        for ii in range(0, len(samples), chunk_size):
+            stats.add_batch(samples[ii:ii + chunk_size], was_draws[ii:ii + chunk_size])
+
+        for name in STATS_ATTRS:
+            assert getattr(stats, name) == getattr(expect, name), name
+
+    # and against the samples directly
+    by_match = {}
+    for sample in samples:
+        by_match.setdefault(sample.match_identifier, []).append(sample.depth)
+
+    assert expect.unique_matches == len(by_match)
+    assert expect.av_starting_depth == sum(d[0] for d in by_match.values()) / float(len(by_match))
+    assert expect.av_ending_depth == sum(d[-1] for d in by_match.values()) / float(len(by_match))
+
+    counts = [0 for _ in expect.total_puct_score_dist]
+    for sample in samples:
+        indx = 0
+        for ii, (upper_limit, _) in enumerate(expect.total_puct_score_dist):
+            if sample.resultant_puct_score[0] - 0.0001 >= upper_limit:
+                indx = ii
+        counts[indx] += 1
+
+    assert [total for _, total in expect.total_puct_score_dist] == counts
+
+
 def test_chunking():
     game = "breakthroughSmall"
     cache = setup_and_get_cache(game, 1, "t1")
@@ -72,6 +140,14 @@ def test_chunking():
     #z.sort()
     #print z
 
+    # epochs are numpy arrays of unique indices
+    assert z.dtype == np.int64
+    assert len(np.unique(z)) == len(z)
+
+    # a plain shuffle (no window) doesn't touch the db
+    cache.db = None
+    assert cache.create_chunk_indexer(buckets).chunk_len is None
+
 
 def test_include_size():
     game = "breakthroughSmall"
@@ -88,3 +164,476 @@ def test_include_size():
     z = indexer.get_indices(max_size=40000, include_all=2)
     #z.sort()
     #print z
+
+
+def test_empty_levels():
+    # steps with no rows (an empty gendata file) are skipped
+    step_summaries = [datadesc.StepSummary(step=step, num_samples=num_samples,
+                                           stats_unique_matches=num_samples / 10)
+                      for step, num_samples in enumerate([100, 0, 50, 0])]
+
+    buckets = datacache.Buckets([(1, 1.0), (3, 0.75), (-1, 0.5)])
+    indexer = datacache.ChunkIndexer(buckets, step_summaries)
+    indexer.find_levels(validation_split=0.8)
+
+    for validation in (False, True):
+        for max_size in (None, 10, 1000):
+            z = indexer.get_indices(max_size=max_size, validation=validation)
+            assert len(np.unique(z)) == len(z)
+            assert ((z >= 0) & (z < 150)).all()
+
+    # and so are the stats of a step with no samples
+    stats = datacache.StatsAccumulator()
+    for name in STATS_ATTRS:
+        getattr(stats, name)
+
+
+def rebuild_cache(cache):
+    # removes db(s) and summary, so next sync() will rebuild from scratch
+    for fn in os.listdir(cache.data_path):
+        if fn.startswith("__db"):
+            shutil.rmtree(os.path.join(cache.data_path, fn))
+    os.remove(cache.summary_path)
+
+
+def assert_same_batches(expect, batches):
+    ' batches (inputs, outputs) are the same, and in the same order as expect '
+    expect = list(expect)
+    batches = list(batches)
+    assert len(batches) == len(expect)
+
+    for (expect_inputs, expect_outputs), (inputs, outputs) in zip(expect, batches):
+        assert (inputs == expect_inputs).all()
+        assert len(outputs) == len(expect_outputs)
+        for output, expect_output in zip(outputs, expect_outputs):
+            assert (output == expect_output).all()
+
+
+def test_sync_workers():
+    for db_backend in sorted(storage.BACKENDS):
+        game = "breakthroughSmall"
+        cache = setup_and_get_cache(game, 1, "t1", db_backend=db_backend)
+        cache.sync()
+        serial = [cache.db[name][:] for name in cache.db.names]
+
+        rebuild_cache(cache)
+        cache = setup_and_get_cache(game, 1, "t1", db_backend=db_backend)
+        cache.sync(num_workers=3)
+
+        # same as serial
+        assert cache.db.size == len(serial[0])
+        for name, expect in zip(cache.db.names, serial):
+            assert (cache.db[name][:] == expect).all()
+
+        rebuild_cache(cache)
+
+
+def test_packed_and_sparse():
+    game = "breakthroughSmall"
+    cache = setup_and_get_cache(game, 1, "t1")
+    cache.sync()
+
+    indices = range(cache.total_samples)
+    random.shuffle(indices)
+    expect = list(cache.generate(indices, 256))
+
+    rebuild_cache(cache)
+
+    for db_backend in sorted(storage.BACKENDS):
+        cache = setup_and_get_cache(game, 1, "t1", packed_states=True, sparse_policies=True,
+                                    db_backend=db_backend)
+        cache.sync()
+
+        # channels / policies are created in generate(), should be the same as stored in db
+        assert_same_batches(expect, cache.generate(indices, 256))
+
+        rebuild_cache(cache)
+
+
+def test_prefetch():
+    game = "breakthroughSmall"
+    cache = setup_and_get_cache(game, 1, "t1")
+    cache.sync()
+
+    indices = range(cache.total_samples)
+    random.shuffle(indices)
+    expect = list(cache.generate(indices, 100))
+
+    for num_threads in (1, 3):
+        prefetcher = cache.prefetch_generate(indices, 100, queue_depth=4, num_threads=num_threads)
+
+        # same batches, same order
+        assert_same_batches(expect, prefetcher)
+
+    # two prefetchers at once (as training and validation), each reads through its own handles
+    first = cache.prefetch_generate(indices[::2], 100, num_threads=2)
+    second = cache.prefetch_generate(indices[1::2], 100, num_threads=2)
+    assert_same_batches(cache.generate(indices[::2], 100), first)
+    assert_same_batches(cache.generate(indices[1::2], 100), second)
+
+
+def test_block_shuffle():
+    indices = np.arange(0, 10000, 3)
+    shuffled = datacache.block_shuffle(indices, 100, 4)
+
+    # a permutation
+    assert (np.sort(shuffled) == indices).all()
+    assert (shuffled != indices).any()
+
+    # each window of indices only reads from 4 chunks (100 chunks, so 25 windows)
+    windows = 0
+    while len(shuffled):
+        chunks = set()
+        size = 0
+        for index in shuffled:
+            chunks.add(index // 100)
+            if len(chunks) > 4:
+                break
+            size += 1
+
+        shuffled = shuffled[size:]
+        windows += 1
+
+    assert windows == 25
+
+
+def test_fingerprints():
+    game = "breakthroughSmall"
+    cache = setup_and_get_cache(game, 1, "t1")
+    cache.sync()
+
+    files = list(cache.list_files())
+    fingerprints = cache.get_fingerprints()
+    assert len(fingerprints) == len(files)
+    for step, file_path, md5sum in files:
+        assert fingerprints[file_path].md5sum == md5sum == datacache.md5sum_file(file_path)
+
+    # touching a file invalidates its fingerprint, but the md5sum is the same
+    _, file_path, md5sum = files[0]
+    os.utime(file_path, None)
+    assert list(cache.list_files()) == files
+    assert cache.get_fingerprints()[file_path] != fingerprints[file_path]
+
+    cache = setup_and_get_cache(game, 1, "t1", deep_verify=True)
+    assert list(cache.list_files()) == files
+    assert cache.check_summary()
+
+
+def test_converted_files():
+    game = "breakthroughSmall"
+    cache = setup_and_get_cache(game, 1, "t1")
+    cache.sync()
+
+    step_sum = cache.summary.step_summaries[0]
+    assert step_sum.filename.endswith(gendata.JSON_EXT)
+    assert step_sum.file_num_samples is not None
+
+    # converting a file keeps the same samples, so the summary is still valid
+    binary_path = gendata.convert_to_binary(step_sum.filename)
+    try:
+        cache = setup_and_get_cache(game, 1, "t1")
+        assert cache.check_summary()
+
+        # but not if a different file takes its place
+        gendata.write_binary(binary_path, gendata.read_header(binary_path), [])
+        cache = setup_and_get_cache(game, 1, "t1")
+        assert not cache.check_summary()
+
+    finally:
+        os.remove(binary_path)
+
+
+def test_lazy_augment():
+    game = "breakthroughSmall"
+    cache = setup_and_get_cache(game, 1, "t1", packed_states=True)
+    cache.sync()
+    total_samples = cache.total_samples
+    rebuild_cache(cache)
+
+    cache = setup_and_get_cache(game, 1, "t1", packed_states=True,
+                                do_augment_data=True, lazy_augment=True)
+    cache.sync()
+
+    # db only has the samples as played
+    assert cache.total_samples == total_samples
+
+    indices = range(cache.total_samples)
+    expect = list(cache.generate(indices, 256))
+
+    # only training batches are augmented
+    num_changed = 0
+    for (expect_inputs, _), (inputs, outputs) in zip(expect, cache.generate(indices, 256, augment=True)):
+        assert inputs.shape == expect_inputs.shape
+        num_changed += sum((i != e).any() for i, e in zip(inputs, expect_inputs))
+
+    assert num_changed > 0
+
+    # no translations
+    cache.data_augment_pct = 0.0
+    for (expect_inputs, _), (inputs, _) in zip(expect, cache.generate(indices, 256, augment=True)):
+        assert (inputs == expect_inputs).all()
+
+    rebuild_cache(cache)
+
+
+def test_compact():
+    assert datacache.Buckets([]).window() is None
+    assert datacache.Buckets([(1, 1.0), (-1, 0.1)]).window() is None
+    assert datacache.Buckets([(1, 1.0), (3, 0.75), (6, 0.5)]).window() == 6
+
+    game = "breakthroughSmall"
+    for db_backend in sorted(storage.BACKENDS):
+        cache = setup_and_get_cache(game, 1, "t1", packed_states=True, sparse_policies=True,
+                                    db_backend=db_backend)
+        cache.sync()
+
+        num_steps = len(cache.summary.step_summaries)
+        assert num_steps > 2
+
+        keep_samples = sum(s.num_samples for s in cache.summary.step_summaries[-2:])
+        expect = list(cache.generate(range(cache.total_samples - keep_samples, cache.total_samples), 256))
+
+        # the window counts back from the step trained at, later steps are kept
+        buckets = datacache.Buckets([(1, 1.0), (2, 0.5)])
+        earlier = cache.summary.step_summaries[-2].step
+        assert cache.compact(buckets, starting_step=earlier) == num_steps - 3
+        assert [s.step for s in cache.summary.step_summaries] == [earlier - 1, earlier, earlier + 1]
+
+        assert cache.compact(buckets) == 1
+        assert cache.total_samples == cache.db.size == keep_samples
+        assert cache.summary.first_step == num_steps - 2
+
+        # same samples, and still valid when reopened
+        assert_same_batches(expect, cache.generate(range(keep_samples), 256))
+
+        cache = setup_and_get_cache(game, 1, "t1", packed_states=True, sparse_policies=True,
+                                    db_backend=db_backend)
+        assert cache.check_summary() and cache.verify_db()
+
+        rebuild_cache(cache)
+
+
+def test_ingest_metrics():
+    game = "breakthroughSmall"
+    cache = setup_and_get_cache(game, 1, "t1")
+    rebuild_cache(cache)
+    if os.path.exists(cache.metrics_path):
+        os.remove(cache.metrics_path)
+
+    cache = setup_and_get_cache(game, 1, "t1")
+    cache.sync()
+
+    # one entry per file ingested, with the samples of each stage
+    ingests = cache.get_ingest_metrics().ingests
+    assert len(ingests) == len(cache.summary.step_summaries)
+    for m, step_summary in zip(ingests, cache.summary.step_summaries):
+        assert m.step == step_summary.step
+        assert m.num_samples == step_summary.num_samples
+
+        stages = dict((s.name, s) for s in m.stages)
+        for name in "read stats decode channels outputs db_insert".split():
+            assert stages[name].samples == m.num_samples
+
+        assert stages["read"].bytes_read == os.path.getsize(m.filename)
+        assert stages["db_insert"].bytes_written > 0
+
+
+def step_state_keys(cache):
+    ' the state keys of the db, grouped by step '
+    keys = cache.state_keys()
+    ends = np.cumsum([s.num_samples for s in cache.summary.step_summaries])
+    return np.split(keys, ends[:-1])
+
+
+def test_dedupe():
+    game = "breakthroughSmall"
+    for sparse_policies in (False, True):
+        cache = setup_and_get_cache(game, 1, "t1", packed_states=True,
+                                    sparse_policies=sparse_policies, dedupe_states=True)
+        cache.sync()
+
+        total_samples = cache.total_samples
+        num_unique = [len(np.unique(keys)) for keys in step_state_keys(cache)]
+
+        # openings recur in every step
+        assert sum(num_unique) < total_samples
+        assert cache.dedupe() == total_samples - sum(num_unique)
+        assert cache.total_samples == cache.db.size == sum(num_unique)
+
+        # only merged within each step
+        assert [s.num_samples for s in cache.summary.step_summaries] == num_unique
+        assert [len(np.unique(keys)) for keys in step_state_keys(cache)] == num_unique
+        assert cache.summary.deduped_step == cache.summary.step_summaries[-1].step
+
+        # every sample is accounted for by the counts
+        assert cache.db["count"][:].sum() == total_samples
+        assert cache.total_samples == sum(s.num_samples for s in cache.summary.step_summaries)
+
+        # policies are still distributions
+        for _, outputs in cache.generate(range(cache.total_samples), 256):
+            for ri in range(cache.transformer.role_count):
+                assert np.allclose(outputs[ri].sum(axis=1), 1.0, atol=1e-3)
+
+        # nothing left to merge, and still valid when reopened
+        assert cache.dedupe() == 0
+        cache = setup_and_get_cache(game, 1, "t1", packed_states=True,
+                                    sparse_policies=sparse_policies, dedupe_states=True)
+        assert cache.check_summary() and cache.verify_db()
+
+        rebuild_cache(cache)
+
+
+def test_dedupe_new_steps():
+    game = "breakthroughSmall"
+    cache = setup_and_get_cache(game, 1, "t1", packed_states=True, sparse_policies=True,
+                                dedupe_states=True)
+    cache.sync()
+    cache.dedupe()
+
+    num_rows = cache.db.size
+    expect = list(cache.generate(range(num_rows), 256))
+
+    # a new step (a copy of the last one), only its rows are merged
+    step_sum = cache.summary.step_summaries[-1]
+    new_path = step_sum.filename.replace("_%d." % step_sum.step, "_%d." % (step_sum.step + 1))
+    shutil.copy(step_sum.filename, new_path)
+    try:
+        cache.sync()
+        num_unique = len(np.unique(cache.state_keys(num_rows)))
+        assert cache.dedupe() == cache.db.size - num_rows - num_unique
+        assert cache.db.size == num_rows + num_unique
+        assert cache.summary.deduped_step == step_sum.step + 1
+
+        # the rows of the steps already merged are as they were
+        assert_same_batches(expect, cache.generate(range(num_rows), 256))
+
+    finally:
+        os.remove(new_path)
+        rebuild_cache(cache)
+
+
+def test_sequence():
+    from ggpzero.nn.train import DataCacheSequence
+
+    game = "breakthroughSmall"
+    for db_backend in sorted(storage.BACKENDS):
+        cache = setup_and_get_cache(game, 1, "t1", packed_states=True, sparse_policies=True,
+                                    db_backend=db_backend)
+        cache.sync()
+
+        indices = np.random.permutation(cache.total_samples)
+        expect = list(cache.generate(indices, 100))
+
+        sequence = DataCacheSequence(cache, indices, 100)
+        assert len(sequence) == len(expect)
+
+        # as if in a forked worker, the db is reopened read only
+        sequence.pid = -1
+        order = list(reversed(range(len(sequence))))
+        assert_same_batches([expect[ii] for ii in order], [sequence[ii] for ii in order])
+
+        rebuild_cache(cache)
+
+
+def test_resident_set():
+    game = "breakthroughSmall"
+    cache = setup_and_get_cache(game, 1, "t1")
+    cache.sync()
+
+    indexer = cache.create_chunk_indexer(datacache.Buckets([(1, 1.0), (-1, 0.5)]))
+    indices, inputs, outputs = cache.resident_set(lambda: indexer.validation_epoch(1000),
+                                                  cache_key="test")
+
+    # same as generating batches
+    assert_same_batches([cache.get_batch(indices)], [(inputs, outputs)])
+
+    # loaded, rather than regathered
+    def fail():
+        assert False, "should be loaded from file"
+
+    saved_indices, saved_inputs, saved_outputs = cache.resident_set(fail, cache_key="test")
+    assert (saved_indices == indices).all()
+    assert_same_batches([(inputs, outputs)], [(saved_inputs, saved_outputs)])
+
+    os.remove(cache.resident_set_path("test"))
+
+    # no rows (eg no validation samples), shaped as a batch would be
+    _, empty_inputs, empty_outputs = cache.resident_set(lambda: np.zeros(0, dtype=np.int64))
+    assert empty_inputs.shape == (0,) + inputs.shape[1:]
+    assert empty_inputs.dtype == inputs.dtype
+    assert len(empty_outputs) == len(outputs)
+    for empty_output, output in zip(empty_outputs, outputs):
+        assert empty_output.shape == (0,) + output.shape[1:]
+        assert empty_output.dtype == output.dtype
+
+
+def test_compact_inputs():
+    game = "breakthroughSmall"
+    cache = setup_and_get_cache(game, 1, "t1")
+    cache.sync()
+
+    indices = range(cache.total_samples)
+    random.shuffle(indices)
+    expect = list(cache.generate(indices, 256))
+
+    rebuild_cache(cache)
+
+    for packed_states in (False, True):
+        cache = setup_and_get_cache(game, 1, "t1", packed_states=packed_states, compact_inputs=True)
+        cache.sync()
+
+        if not packed_states:
+            assert cache.db["channels"].dtype == np.uint8
+
+        # same inputs, just smaller
+        batches = list(cache.generate(indices, 256))
+        assert all(inputs.dtype == np.float16 for inputs, _ in batches)
+        assert_same_batches(expect, batches)
+
+        rebuild_cache(cache)
+
+
+def test_changed_options():
+    game = "breakthroughSmall"
+    cache = setup_and_get_cache(game, 1, "t1")
+    cache.sync()
+
+    indices = range(cache.total_samples)
+    random.shuffle(indices)
+    expect = list(cache.generate(indices, 256))
+
+    # the existing db has a different layout for each of these, so is rebuilt on sync()
+    for kwds in (dict(compact_inputs=True),
+                 dict(packed_states=True, sparse_policies=True),
+                 dict(packed_states=True, dedupe_states=True),
+                 dict(),
+                 dict(db_backend="npy")):
+        cache = setup_and_get_cache(game, 1, "t1", **kwds)
+        cache.sync()
+
+        assert cache.db.names == cache.column_names
+        assert cache.db.size == cache.summary.total_samples
+        if kwds.get("compact_inputs"):
+            assert cache.db["channels"].dtype == np.uint8
+
+        policy_dbs = [fn for fn in os.listdir(cache.data_path)
+                      if fn.startswith("__db_policy") and fn.endswith("__")]
+        assert len(policy_dbs) == (2 if kwds.get("sparse_policies") else 0)
+
+        # the previous db is kept as a backup
+        assert os.path.exists(cache.db_path + ".old")
+
+        assert_same_batches(expect, cache.generate(indices, 256))
+
+    # a broken db (rather than a different layout) is an error, and isn't rebuilt
+    with open(os.path.join(cache.db_path, storage.NpyTable.META_FILENAME), "w") as f:
+        f.write("{")
+
+    cache = setup_and_get_cache(game, 1, "t1", db_backend="npy")
+    try:
+        cache.sync()
+        assert False, "broken db was rebuilt"
+    except ValueError:
+        pass
+
+    rebuild_cache(cache)
@@ -1,5 +1,8 @@
 import os
+import copy
 import random
+import shutil
+import tempfile
 
 import numpy as np
 
@@ -11,7 +14,7 @@ from ggplib.db import lookup
 from ggpzero.util import keras
 from ggpzero.defs import templates
 
-from ggpzero.nn.manager import get_manager
+from ggpzero.nn.manager import get_manager, Manager
 
 def setup():
     # set up ggplib
@@ -141,6 +144,168 @@ def test_config_previous_states():
         print transformer.state_to_channels(basestate2.to_list(), [basestate1.to_list(),
                                                                    basestate0.to_list()])
 
+def test_packed_states_to_channels():
+    from ggpzero.util.state import pack_state
+    man = get_manager()
+
+    for game in games:
+        generation_descr = templates.default_generation_desc(game)
+        generation_descr.num_previous_states = 2
+        transformer = man.get_transformer(game, generation_descr)
+
+        game_info = lookup.by_name(game)
+        sm = game_info.get_sm()
+
+        states = [sm.get_initial_state()]
+        for _ in range(5):
+            states.append(advance_state(game_info.get_sm(), states[-1]))
+        states = [s.to_list() for s in states]
+
+        expect = []
+        packed_states = []
+        packed_prev_states = np.zeros((len(states), 2, transformer.num_packed_bytes), dtype=np.uint8)
+        for ii, state in enumerate(states):
+            prev_states = states[max(0, ii - 2):ii][::-1]
+            expect.append(transformer.state_to_channels(state, prev_states))
+
+            packed_states.append(pack_state(state))
+            for jj, prev_state in enumerate(prev_states):
+                packed_prev_states[ii, jj] = pack_state(prev_state)
+
+        channels = transformer.packed_states_to_channels(np.array(packed_states), packed_prev_states)
+        assert channels.shape == (len(states),) + expect[0].shape
+        assert (channels == np.array(expect)).all()
+
+        # and from decoded states
+        channels = transformer.states_to_channels(np.unpackbits(np.array(packed_states), axis=-1),
+                                                  np.unpackbits(packed_prev_states, axis=-1))
+        assert (channels == np.array(expect)).all()
+
+
+def test_compact_input_dtype():
+    from ggpzero.nn.bases import BaseToChannelSpace
+    man = get_manager()
+
+    # a copy, as the manager shares transformers
+    transformer = copy.copy(man.get_transformer("breakthroughSmall"))
+    transformer.num_of_controls_channels = 2
+
+    # values of the control bases of a channel are summed
+    for values, expect in (([1, 1], np.uint8),
+                           ([200, 55], np.uint8),
+                           ([200, 56], np.float16),
+                           ([-1, 1], np.float16),
+                           ([0.5, 1], np.float16),
+                           ([60000, 60000], np.float32)):
+        transformer.control_space = [BaseToChannelSpace(ii, 0, v) for ii, v in enumerate(values)]
+        assert transformer.compact_input_dtype == expect
+
+    # but not those of different channels
+    transformer.control_space = [BaseToChannelSpace(0, 0, 200), BaseToChannelSpace(1, 1, 200)]
+    assert transformer.compact_input_dtype == np.uint8
+
+
+def test_channel_last_inputs():
+    from ggpzero.util.state import pack_states
+    man = get_manager()
+
+    for game in games:
+        transformers = []
+        for channel_last in (False, True):
+            generation_descr = templates.default_generation_desc(game)
+            generation_descr.num_previous_states = 2
+            generation_descr.channel_last = channel_last
+            transformers.append(man.get_transformer(game, generation_descr))
+
+        first, last = transformers
+
+        game_info = lookup.by_name(game)
+        sm = game_info.get_sm()
+
+        states = [sm.get_initial_state()]
+        for _ in range(5):
+            states.append(advance_state(game_info.get_sm(), states[-1]))
+        states = [s.to_list() for s in states]
+
+        packed_states = pack_states(states)
+        packed_prev_states = np.zeros((len(states), 2, first.num_packed_bytes), dtype=np.uint8)
+        for ii in range(len(states)):
+            prev_states = states[max(0, ii - 2):ii][::-1]
+            if prev_states:
+                packed_prev_states[ii, :len(prev_states)] = pack_states(prev_states)
+
+            # per sample
+            expect = first.state_to_channels(states[ii], prev_states)
+            channels = last.state_to_channels(states[ii], prev_states)
+            assert channels.flags.c_contiguous
+            assert (channels == expect.transpose(1, 2, 0)).all()
+
+        # batches, the same inputs in either layout
+        expect = first.packed_states_to_channels(packed_states, packed_prev_states)
+        channels = last.packed_states_to_channels(packed_states, packed_prev_states)
+        assert channels.flags.c_contiguous
+        assert channels.shape == (len(states), last.num_cols, last.num_rows, last.num_channels)
+        assert (channels == expect.transpose(0, 2, 3, 1)).all()
+
+
+def test_batch_targets():
+    man = get_manager()
+
+    for game in games:
+        for draw_head in (False, True):
+            generation_descr = templates.default_generation_desc(game)
+            generation_descr.draw_head = draw_head
+            transformer = man.get_transformer(game, generation_descr)
+
+            values = [random.choice([[1.0, 0.0], [0.0, 1.0], [0.5, 0.5]]) for _ in range(100)]
+            expect = np.array([transformer.value_to_array(v) for v in values])
+            assert (transformer.values_to_array(values) == expect).all()
+
+            for ri, dist_count in enumerate(transformer.policy_dist_count):
+                policies = []
+                for _ in range(100):
+                    legals = random.sample(range(dist_count), random.randint(1, min(5, dist_count)))
+                    policies.append([(legal, 1.0 / len(legals)) for legal in legals])
+
+                expect = np.array([transformer.policy_to_array(p, ri) for p in policies])
+                array = transformer.policies_to_array([l for p in policies for l, _ in p],
+                                                      [x for p in policies for _, x in p],
+                                                      [len(p) for p in policies], ri)
+                assert (array == expect).all()
+
+
+def test_cached_transformer_spaces():
+    data_path = tempfile.mkdtemp()
+    try:
+        for game in games:
+            generation_descr = templates.default_generation_desc(game)
+
+            # first manager computes and saves the spaces, the second loads them
+            transformers = []
+            for _ in range(2):
+                transformer = Manager(data_path).get_transformer(game, generation_descr)
+                transformers.append(transformer)
+
+            assert len(os.listdir(Manager(data_path).transformer_path(game))) == 1
+
+            computed, loaded = transformers
+            assert computed.get_spaces() == loaded.get_spaces()
+            assert computed.num_channels == loaded.num_channels
+            assert (computed.board_space_flat_idx == loaded.board_space_flat_idx).all()
+            assert (computed.control_space_bases == loaded.control_space_bases).all()
+
+            game_info = lookup.by_name(game)
+            sm = game_info.get_sm()
+            basestate = sm.get_initial_state()
+            for _ in range(5):
+                basestate = advance_state(sm, basestate)
+                state = basestate.to_list()
+                assert (computed.state_to_channels(state) == loaded.state_to_channels(state)).all()
+
+    finally:
+        shutil.rmtree(data_path)
+
+
 def test_net_create():
     man = get_manager()
 
@@ -0,0 +1,71 @@
+import shutil
+import tempfile
+
+import numpy as np
+
+from ggpzero.nn import storage
+
+
+def test_npy_table():
+    tmp_path = tempfile.mkdtemp()
+    try:
+        rootdir = tmp_path + "/__db__"
+        cols = [np.zeros((1, 3, 4, 4), dtype=np.float32),
+                np.zeros((1,), dtype=np.int64),
+                np.zeros((1, 2), dtype=np.float32)]
+        names = ["channels", "start", "value"]
+
+        backend = storage.get_backend("npy")
+        table = backend.create_table(rootdir, cols, names)
+        assert table.names == names
+        assert table.size == 0
+
+        def rows(start, n):
+            return [np.arange(start, start + n, dtype=np.float32).repeat(48).reshape(n, 3, 4, 4),
+                    np.arange(start, start + n, dtype=np.int64),
+                    np.arange(start, start + n, dtype=np.float32).repeat(2).reshape(n, 2)]
+
+        table.append(rows(0, 10))
+        table.append(rows(10, 5))
+        assert table.size == 15
+
+        # not flushed, so reopening doesn't see them
+        assert backend.open_table(rootdir).size == 0
+
+        table.flush()
+        table = backend.open_table(rootdir)
+        assert table.size == 15
+        assert table["channels"].shape == (15, 3, 4, 4)
+        assert table["start"].dtype == np.int64
+        assert (table["start"][:] == np.arange(15)).all()
+
+        record = table[[14, 2, 7]]
+        assert (record["start"] == [14, 2, 7]).all()
+        assert (record["channels"][1] == 2).all()
+        assert (record["value"][2] == 7).all()
+        assert table[3]["start"] == 3
+
+        # also a valid .npy file
+        assert (np.load(table.column_path("value"))[:, 0] == np.arange(15)).all()
+
+        table.resize(12)
+        table.append(rows(100, 1))
+        table.flush()
+        table = backend.open_table(rootdir)
+        assert table.size == 13
+        assert table[12]["start"] == 100
+
+        # an interrupted flush (one column updated), is only repaired when writable
+        table.append(rows(200, 2))
+        table.columns[0].flush()
+        try:
+            backend.open_table(rootdir, readonly=True)
+            assert False, "should raise"
+        except Exception as exc:
+            assert "different sizes" in str(exc)
+
+        assert backend.open_table(rootdir).size == 13
+        assert backend.open_table(rootdir, readonly=True).size == 13
+
+    finally:
+        shutil.rmtree(tmp_path)
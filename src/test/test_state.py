@@ -3,7 +3,7 @@ import random
 
 from ggplib.db import lookup
 
-from ggpzero.util.state import encode_state, decode_state, fast_decode_state
+from ggpzero.util.state import encode_state, decode_state, fast_decode_state, decode_states
 
 games = ["breakthrough", "hex", "hexLG13"]
 
@@ -112,6 +112,30 @@ def test_more():
         print "good", game
 
 
+def test_decode_states():
+    for game in games:
+        sm = lookup.by_name(game).get_sm()
+        num_bases = len(sm.get_initial_state().to_list())
+
+        bs = sm.new_base_state()
+        bs.assign(sm.get_initial_state())
+
+        states = []
+        for i in range(10):
+            states.append(bs.to_list())
+            advance_state(sm, bs)
+
+        encoded = [encode_state(s) for s in states]
+        matrix = decode_states(encoded, num_bases)
+        assert matrix.shape == (10, num_bases)
+
+        # same as decoding one by one, and works for decoded states too
+        for row, s in zip(matrix, encoded):
+            assert tuple(row) == decode_state(s)[:num_bases]
+
+        assert (decode_states(states, num_bases) == matrix).all()
+
+
 def test_speed():
     import time
 
@@ -2,6 +2,8 @@ import random
 from pprint import pprint
 from functools import partial
 
+import numpy as np
+
 from ggplib.db import lookup
 from ggpzero.util import symmetry as sym
 from ggpzero.nn.manager import get_manager
@@ -218,6 +220,16 @@ def game_test(game, pretty_board, advance_state_count):
 
         assert basestate_list == basestate2_list
 
+        # compiled permutations, as a batch
+        batch = np.array([basestate.to_list()] * 3, dtype=np.uint8)
+        for translated in t.translate_basestates(batch, do_reflection, rot_count):
+            assert translated.tolist() == basestate_list
+
+        for ri in range(len(sm.get_roles())):
+            legals = np.arange(len(info.model.actions[ri]))
+            expect = [t.translate_action(ri, legal, do_reflection, rot_count) for legal in legals]
+            assert t.translate_legals(ri, legals, do_reflection, rot_count).tolist() == expect
+
         translated_moves = translate_moves(sm, basestate, t, do_reflection, rot_count)
 
         translated_basestate.from_list(basestate_list)
@@ -230,6 +242,36 @@ def game_test(game, pretty_board, advance_state_count):
             print role, moves
 
 
+def test_untranslatable_action():
+    game = "breakthroughSmall"
+    info = lookup.by_name(game)
+    transformer = get_manager().get_transformer(game)
+    t = sym.create_translator(info, transformer.game_desc, transformer.get_symmetries_desc())
+
+    # as if the first action had no translation
+    mapping = t.action_mapping(0, True, 0).copy()
+    lost = mapping[0]
+    mapping[0] = -1
+    t.action_mappings[0, True, 0] = mapping
+
+    # fine, as long as it isn't used
+    assert t.translate_legals(0, np.array([1, 2]), True, 0).tolist() == mapping[[1, 2]].tolist()
+
+    policies = np.zeros((2, len(mapping)), dtype=np.float32)
+    policies[:, 1:] = 1.0 / (len(mapping) - 1)
+    translated = t.translate_policies(0, policies, True, 0)
+    assert (translated[:, lost] == 0).all()
+    assert np.allclose(translated.sum(axis=1), 1.0)
+
+    for fn in (lambda: t.translate_legals(0, np.array([0, 1]), True, 0),
+               lambda: t.translate_policies(0, np.eye(len(mapping), dtype=np.float32), True, 0)):
+        try:
+            fn()
+            assert False, "should raise"
+        except AssertionError as exc:
+            assert "Did not find translation" in str(exc)
+
+
 def test_game_reversi():
     from ggpzero.battle.reversi import pretty_board
     game_test("reversi", partial(pretty_board, 8), 5)
@@ -2,7 +2,7 @@ from pprint import pprint
 
 import attr
 
-from ggpzero.util import attrutil, func, broker, runprocs
+from ggpzero.util import attrutil, func, broker, runprocs, gendata
 
 
 def setup():
@@ -16,6 +16,12 @@ def test_chunks():
     assert res[4] == [8, 9]
 
 
+def test_ichunks():
+    res = list(func.ichunks(iter(range(10)), 4))
+    assert res == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    assert list(func.ichunks(iter([]), 4)) == []
+
+
 def test_challenge():
     m = broker.challenge(128)
 
@@ -176,6 +182,109 @@ def test_attrs_clone():
     assert s1.data[2] == 3
 
 
+def test_gendata_reader():
+    import os
+    import gzip
+    import tempfile
+    from ggpzero.defs import datadesc
+
+    gen_samples = datadesc.GenerationSamples(game="game", with_generation="x_1", num_samples=100)
+    for ii in range(100):
+        gen_samples.samples.append(datadesc.Sample(state="abc", prev_states=["def"],
+                                                   policies=[[(ii, 1.0)], [(0, 1.0)]],
+                                                   match_identifier="m%d" % ii))
+
+    fd, path = tempfile.mkstemp(suffix=".json.gz")
+    os.close(fd)
+    try:
+        with gzip.open(path, 'w') as f:
+            f.write(attrutil.attr_to_json(gen_samples))
+
+        # tiny read size, so samples are split between reads
+        reader = gendata.GenDataReader(path, read_size=37)
+        chunks = list(reader.iter_chunks(30))
+        assert [len(c) for c in chunks] == [30, 30, 30, 10]
+
+        expect = attrutil.json_to_attr(gzip.open(path).read())
+        assert [s for c in chunks for s in c] == expect.samples
+
+        assert reader.header.with_generation == "x_1"
+        assert reader.header.num_samples == 100
+        assert reader.header.samples == []
+
+    finally:
+        os.remove(path)
+
+
+def test_gendata_binary():
+    import os
+    import gzip
+    import random
+    import tempfile
+    import numpy as np
+    from ggpzero.defs import datadesc
+    from ggpzero.util.state import encode_state
+
+    gen_samples = datadesc.GenerationSamples(game="game", with_generation="x_1", num_samples=100)
+    for ii in range(100):
+        state = encode_state([random.randint(0, 1) for _ in range(42)])
+        prev_states = [encode_state([random.randint(0, 1) for _ in range(42)])
+                       for _ in range(ii % 3)]
+        gen_samples.samples.append(datadesc.Sample(state=state, prev_states=prev_states,
+                                                   policies=[[(ii, 0.25), (ii + 1, 0.75)], [(0, 1.0)]],
+                                                   final_score=[1.0, 0.0],
+                                                   resultant_puct_score=[0.5, 0.5],
+                                                   match_identifier="m%d" % (ii / 10),
+                                                   has_resigned=ii % 7 == 0))
+
+    fd, json_path = tempfile.mkstemp(suffix=gendata.JSON_EXT)
+    os.close(fd)
+    try:
+        with gzip.open(json_path, 'w') as f:
+            f.write(attrutil.attr_to_json(gen_samples))
+
+        binary_path = gendata.convert_to_binary(json_path)
+        assert binary_path.endswith(gendata.BINARY_EXT)
+
+        reader = gendata.get_reader(binary_path)
+        assert isinstance(reader, gendata.GenDataBinaryReader)
+        chunks = list(reader.iter_chunks(30))
+        assert [len(c) for c in chunks] == [30, 30, 30, 10]
+
+        # the same samples (policies are tuples, rather than lists)
+        for sample, expect in zip([s for c in chunks for s in c], gen_samples.samples):
+            sample.policies = [[tuple(pair) for pair in p] for p in sample.policies]
+            assert sample == expect
+
+        assert reader.header.with_generation == "x_1"
+        assert reader.header.num_samples == 100
+        assert reader.header.samples == []
+
+        # the columns are the same from either format
+        json_chunks = list(gendata.get_reader(json_path).iter_column_chunks(30))
+        binary_chunks = list(reader.iter_column_chunks(30))
+        assert len(json_chunks) == len(binary_chunks) == 4
+        for json_cols, binary_cols in zip(json_chunks, binary_chunks):
+            assert sorted(json_cols) == sorted(binary_cols)
+            for name in json_cols:
+                assert np.array_equal(json_cols[name], binary_cols[name]), name
+
+        os.remove(binary_path)
+
+        # no samples
+        gen_samples.samples = []
+        gendata.write_binary(binary_path, gen_samples, [])
+        reader = gendata.get_reader(binary_path)
+        assert list(reader.iter_samples()) == []
+        assert list(reader.iter_column_chunks(30)) == []
+        assert reader.header.num_samples == 0
+
+        os.remove(binary_path)
+
+    finally:
+        os.remove(json_path)
+
+
 def test_runcmds():
     from twisted.internet import reactor
 